@@ -177,27 +177,32 @@ if __name__ == "__main__":
     scroll.grid(row=1, column=1, sticky="NSEW")
 
     # used store a reference to the displayed image to we can save it
+    # None if the displayed image is a preview of blending result_collage, which is blended at full size on save
     result_img = None
     # ------------------ end left panel ------------------------
 
-    def show_img(img: Union[np.ndarray, Future, Tuple[np.ndarray, str], None], printDone: bool = True) -> None:
+    def show_img(img: Union[np.ndarray, Future, Tuple[np.ndarray, str], None], printDone: bool = True, preview=False) -> None:
         """
         display an image in the canvas and set the global variable result_img to img
+
+        :param preview: img is a display-sized preview of the blended result_collage and is not kept for saving
         """
         global result_img, result_tile_info
         if img is None:
             return
         if type(img) == Future:
             img = img.result()
+            if img is None:
+                return
         if type(img) == tuple:
             img, result_tile_info = img
-        result_img = img
+        result_img = None if preview else img
         width, height = canvas.winfo_width(), canvas.winfo_height()
         img_h, img_w, _ = img.shape
         img = mkg.strip_alpha(img)
-        if img_h > height or img_w > width:
+        w, h = limit_wh(img_w, img_h, width, height)
+        if (w, h) != (img_w, img_h):
             print("Resizing image to display it on GUI...")
-            w, h = limit_wh(img_w, img_h, width, height)
             img = cv2.resize(img, (w, h))
         _, data = cv2.imencode(".ppm", img)
         # prevent the image from being garbage-collected
@@ -283,7 +288,7 @@ if __name__ == "__main__":
             if infer_height.get():
                 tile_height.set(shape[0])
             grid = mkg.calc_grid_size(16, 10, len(imgs), shape)
-            return mkg.make_collage(grid, imgs.copy(), False)
+            return mkg.make_collage(grid, imgs, False)
         except AssertionError as e:
             messagebox.showerror("Error", str(e))
         except:
@@ -380,6 +385,13 @@ if __name__ == "__main__":
     Checkbutton(right_sort_opt_panel, variable=rev_sort,
                 text="Reverse sort order").grid(row=3, columnspan=2, sticky="W")
 
+    # right sort option panel ROW 4:
+    layout = StringVar()
+    layout.set("rows")
+    LabelWithTooltip(right_sort_opt_panel, text="Layout:", tooltip=mkg.PARAMS.layout.help).grid(
+        row=4, column=0, sticky="W")
+    OptionMenu(right_sort_opt_panel, layout, "", *mkg.PARAMS.layout.choices).grid(row=4, column=1)
+
     def generate_sorted_image():
         if imgs is None:
             return messagebox.showerror("Empty set", "Please first load tiles")
@@ -393,17 +405,17 @@ if __name__ == "__main__":
 
         def action():
             try:
-                grid, sorted_imgs = mkg.sort_collage(imgs, (w, h), sort_method.get(), rev_sort.get())
-                return mkg.make_collage(grid, sorted_imgs, rev_row.get())
+                grid, order = mkg.sort_collage(imgs, (w, h), sort_method.get(), rev_sort.get(), layout.get())
+                return mkg.make_collage(grid, imgs, rev_row.get() and layout.get() == "rows", order)
             except:
                 messagebox.showerror("Error", traceback.format_exc())
 
         pool.submit(action).add_done_callback(show_img)
 
-    # right sort option panel ROW 4:
+    # right sort option panel ROW 5:
     sort_button = Button(right_sort_opt_panel, text="Generate sorted image", command=generate_sorted_image)
     sort_button.config(state='disabled')
-    sort_button.grid(row=4, columnspan=2, pady=5)
+    sort_button.grid(row=5, columnspan=2, pady=5)
     # ------------------------ end right sort option panel -----------------------------
 
     # ------------------------ right collage option panel ------------------------------
@@ -421,7 +433,7 @@ if __name__ == "__main__":
 
 
     def load_dest_img():
-        global dest_img, result_tile_info
+        global dest_img, result_tile_info, preview
         if imgs is None:
             return messagebox.showerror("Empty set", "Please first load tiles")
 
@@ -435,6 +447,7 @@ if __name__ == "__main__":
                 dest_img = mkg.imread(fp, cv2.IMREAD_UNCHANGED)
                 dest_img_path.set(fp)
                 result_tile_info = None
+                preview = None
                 show_img(dest_img, False)
                 transparent.set(dest_img.shape[2] == 4)
                 is_salient.set(not transparent.get())
@@ -448,15 +461,42 @@ if __name__ == "__main__":
 
     result_collage = None
     result_tile_info = None
+    # display-sized copies of result_collage, its HLS and the destination image, which the slider blends
+    preview = None
+    # the HLS of result_collage, computed on the first full size brightness blend and reused by later ones
+    result_hls = None
+
+    def blend(collage: np.ndarray, dest: np.ndarray, collage_hls: np.ndarray=None) -> np.ndarray:
+        if colorization_opt.get() == "brightness":
+            return mkg.brightness_blend(collage, dest, 1 - alpha_scale.get() / 100, combined_hls=collage_hls)
+        return mkg.alpha_blend(collage, dest, 1 - alpha_scale.get() / 100)
+
+    def make_preview():
+        global preview, result_hls
+        img_h, img_w, _ = result_collage.shape
+        w, h = limit_wh(img_w, img_h, canvas.winfo_width(), canvas.winfo_height())
+        collage = cv2.resize(result_collage, (w, h), interpolation=cv2.INTER_AREA)
+        preview = (collage, cv2.resize(mkg.strip_alpha(dest_img), (w, h), interpolation=cv2.INTER_AREA), 
+                   cv2.cvtColor(collage[:, :, :3], cv2.COLOR_BGR2HLS))
+        result_hls = None
+
     def change_alpha(_=None, show=True):
         if result_collage is not None and dest_img is not None:
-            if colorization_opt.get() == "brightness":
-                img = mkg.brightness_blend(result_collage, dest_img, 1 - alpha_scale.get() / 100)
-            else:
-                img = mkg.alpha_blend(result_collage, dest_img, 1 - alpha_scale.get() / 100)
+            if preview is None:
+                make_preview()
+            img = blend(*preview)
             if show:
-                show_img(img, False)
+                show_img(img, False, preview=True)
             return img
+
+    def blend_result() -> np.ndarray:
+        """
+        blend result_collage at full size
+        """
+        global result_hls
+        if colorization_opt.get() == "brightness" and result_hls is None:
+            result_hls = cv2.cvtColor(result_collage[:, :, :3], cv2.COLOR_BGR2HLS)
+        return blend(result_collage, dest_img, result_hls)
     
     # right collage option panel ROW 3:
     LabelWithTooltip(right_col_opt_panel, text="Color Blend:", tooltip=mkg.PARAMS.blending.help).grid(
@@ -600,13 +640,14 @@ if __name__ == "__main__":
                 global result_collage
                 try:
                     result_collage, tile_info = action()
+                    make_preview()
                     return change_alpha(show=False), tile_info
                 except AssertionError as e:
                     return messagebox.showerror("Error", e)
                 except:
                     messagebox.showerror("Error", traceback.format_exc())
 
-            pool.submit(wrapper).add_done_callback(show_img)
+            pool.submit(wrapper).add_done_callback(lambda f: show_img(f, preview=True))
 
         except AssertionError as e:
             return messagebox.showerror("Error", e)
@@ -678,7 +719,7 @@ if __name__ == "__main__":
 
     def save_img():
         global save_img_init_dir
-        if result_img is None:
+        if result_img is None and result_collage is None:
             messagebox.showerror("Error", "You don't have any image to save yet!")
             return
         
@@ -689,7 +730,7 @@ if __name__ == "__main__":
         if fp is not None and len(fp) > 0 and os.path.isdir(dir_name):
             save_img_init_dir = dir_name
             try:
-                mkg.imwrite(fp, result_img)
+                mkg.imwrite(fp, result_img if result_img is not None else blend_result())
                 print("Image saved to", fp)
             except:
                 messagebox.showerror("Error", traceback.format_exc())
@@ -751,7 +792,11 @@ if __name__ == "__main__":
                 width=event.width - right_panel_width - 20, 
                 height=event.height - log_entry.winfo_height() - 15)
             canvas.update()
-            show_img(result_img, False)
+            if result_img is None and result_collage is not None:
+                make_preview()
+                change_alpha()
+            else:
+                show_img(result_img, False)
 
     root.bind("<Configure>", canvas_resize)
     out_wrapper = log_entry
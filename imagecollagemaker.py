@@ -1,17 +1,23 @@
 import os
+import io
 import sys
 import time
 import math
-import random
+import weakref
+import tarfile
+import zipfile
 import argparse
 import itertools
 import traceback
 import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.pool import ThreadPool
 from fractions import Fraction
-from typing import Any, Callable, List, Tuple, Type
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple, Type, Union
 from collections import defaultdict
 
-from io_utils import stdout_redirector, JVOutWrapper
+from io_utils import stdout_redirector, JVOutWrapper, PNGWriter
+from tile_cache import FeatureCache, NegativeCache, TileCache, file_stat
 
 import cv2
 import imagesize
@@ -21,6 +27,7 @@ from tqdm import tqdm
 from lapjv import lapjv
 
 Grid = Tuple[int, int] # grid size = (width, height)
+BlendFunc = Callable[[np.ndarray, np.ndarray, int], np.ndarray]
 BackgroundRGB = Tuple[int, int, int]
 
 if mp.current_process().name != "MainProcess":
@@ -29,6 +36,11 @@ if mp.current_process().name != "MainProcess":
 
 pbar_ncols = None
 LIMIT = 2**32
+# output encoding options, see set_encode_options
+PNG_COMPRESSION = -1
+JPEG_QUALITY = 95
+FAST_ENCODE = False
+ENCODE_THREADS = 1
 
 
 class _PARAMETER:
@@ -41,15 +53,25 @@ class _PARAMETER:
 
 # We gather parameters here so they can be reused else where
 class PARAMS:
-    path = _PARAMETER(help="Path to the tiles", type=str)
+    path = _PARAMETER(help="Path to the folder of the tiles, or to a zip or tar archive of the tiles", type=str)
     recursive = _PARAMETER(type=bool, default=False, help="Whether to read the sub-folders for the specified path")
     num_process = _PARAMETER(type=int, default=mp.cpu_count() // 2, help="Number of processes to use for parallelizable operations")
     out = _PARAMETER(default="result.png", type=str, help="The filename of the output collage/photomosaic")
-    size = _PARAMETER(type=int, nargs="+", default=(50,), 
+    size = _PARAMETER(type=int, nargs="+", default=None, 
         help="Width and height of each tile in pixels in the resulting collage/photomosaic. "
              "If two numbers are specified, they are treated as width and height. "
              "If one number is specified, the number is treated as the width"
-             "and the height is inferred from the aspect ratios of the images provided. ")
+             "and the height is inferred from the aspect ratios of the images provided. "
+             "Defaults to a width of 50, or with --render_from, to the tile size of the manifest")
+    match_width = _PARAMETER(type=int, default=0,
+        help="If positive and smaller than the tile width, read the tiles as thumbnails of this width, which are only used to "
+             "find the best tiles. Only the tiles used in the output are then decoded at full size, which saves time and memory "
+             "for large tile libraries, especially in unfair mode. 0: always read the tiles at full size")
+    size_sample = _PARAMETER(type=int, default=1000,
+        help="When the tile height is inferred, read the sizes of at most this number of files. Sampling stops as soon as "
+             "the most frequent aspect ratio is clear, and all files are scanned only if it is still ambiguous. "
+             "The sample is the first files found, not a random one: if the aspect ratio depends on the folder "
+             "(e.g. one folder per camera), it is inferred from the first folders scanned. Set to 0 to always scan all files")
     quiet = _PARAMETER(type=bool, default=False, help="Do not print progress message to console")
     auto_rotate = _PARAMETER(type=int, default=0, choices=[-1, 0, 1],
         help="Options to auto rotate tiles to best match the specified tile size. 0: do not auto rotate. "
@@ -69,12 +91,48 @@ class PARAMS:
              "If you run into memory issues when using GPU, try reduce this memory limit")
     tile_info_out = _PARAMETER(type=str, default="",
         help="Path to save the list of tile filenames for the collage/photomosaic. If empty, it will not be saved.")
+    stream = _PARAMETER(type=bool, default=False,
+        help="Render the collage/photomosaic one row of tiles at a time and write each row to the output as soon as it is "
+             "rendered, so that the whole image is never held in memory. Use this for very large outputs. "
+             "The output must be a PNG file. Not applicable to videos")
+    manifest_out = _PARAMETER(type=str, default="",
+        help="Path to save a .npz manifest of the collage/photomosaic: the grid, the tile of each cell and the paths of "
+             "the tiles used. The manifest can be rendered again with --render_from. If empty, it will not be saved.")
+    render_from = _PARAMETER(type=str, default="",
+        help="Render the collage/photomosaic from a manifest saved with --manifest_out instead of computing it. "
+             "Only the tiles used are read, at the size given by --size if specified. --dest_img is only used for blending")
+    png_compression = _PARAMETER(type=int, default=-1,
+        help="zlib compression level of PNG outputs, from 0 (fastest, largest) to 9 (slowest, smallest). "
+             "-1: the OpenCV default for smaller images, and 1 for large images, which are encoded in parallel strips")
+    jpeg_quality = _PARAMETER(type=int, default=95, help="Quality of JPEG outputs, from 0 to 100")
+    fast_encode = _PARAMETER(type=bool, default=False,
+        help="Tune the encoding of the outputs for speed: images from 1 megapixel are encoded in parallel strips, "
+             "and PNG outputs are compressed at level 1 unless --png_compression is given")
+    dzi_format = _PARAMETER(type=str, default="png", choices=["png", "jpg"],
+        help="If the output ends with .dzi, the collage/photomosaic is written as a Deep Zoom image pyramid for zoomable "
+             "viewers, one row of tiles at a time as with --stream. This is the image format of the pyramid tiles")
+    cache_dir = _PARAMETER(type=str, default="",
+        help="Directory of the persistent tile cache. Tiles read before with the same tile size, resize option and auto rotation "
+             "are loaded from the cache, and only new or changed files are decoded. If empty, no cache is used.")
+    dedup = _PARAMETER(type=bool, default=False, 
+        help="Remove near-duplicate tiles (e.g. burst shots or re-encoded copies) after reading them, keeping one tile of each group")
+    dedup_thresh = _PARAMETER(type=int, default=4, 
+        help="Maximum number of differing bits between the 64-bit perceptual hashes of two tiles for them to be duplicates")
+    io_backend = _PARAMETER(type=str, default="process", choices=["process", "thread"],
+        help="How to decode the tiles in parallel. process: use the worker processes. "
+             "thread: use threads of the main process, which write the tiles directly into its memory. "
+             "Decoding and resizing release the GIL, so threads are usually as fast and start faster")
+    io_benchmark = _PARAMETER(type=bool, default=False,
+        help="Time reading the tiles with each io_backend on this machine, then exit")
     
     # ---------------- sort collage options ------------------
     ratio = _PARAMETER(type=int, default=(16, 9), help="Aspect ratio of the output image", nargs=2)
     sort = _PARAMETER(type=str, default="bgr_sum", help="Sort method to use", choices=[
-        "none", "bgr_sum", "av_hue", "av_sat", "av_lum", "rand"
+        "none", "pca_lab", "bgr_sum", "av_hue", "av_sat", "av_lum", "rand"
     ])
+    layout = _PARAMETER(type=str, default="rows", choices=["rows", "gradient"], 
+        help="How to place the tiles. rows: place the sorted tiles row by row. "
+             "gradient: place the tiles along a smooth 2D color gradient. The sort method is not used")
     rev_row = _PARAMETER(type=bool, default=False, help="Whether to use the S-shaped alignment.")
     rev_sort = _PARAMETER(type=bool, default=False, help="Sort in the reverse direction.")
     
@@ -149,7 +207,168 @@ class InfoArray(np.ndarray):
         super(InfoArray, self).__setstate__(state[0:-1])
 
 
-ImgList = List[InfoArray]
+class TileSet:
+    """
+    A set of tiles stored in one contiguous (N, h, w, 3) uint8 buffer, with the filename of each tile kept 
+    in a separate string table
+
+    Indexing with an integer gives a single tile as an InfoArray view. Slicing gives a TileSet sharing the same buffer, 
+    while indexing with an array of indices gathers the tiles into a new TileSet. 
+    If the buffer lives in shared memory or in a memory-mapped file, pickling only sends its location, not the tiles.
+
+    If the tiles were read at a smaller size for matching only, loader decodes the tiles at their full size for rendering.
+    """
+
+    def __init__(self, data: np.ndarray, names, backing: Tuple[str, str, int, np.ndarray]=None, loader: "TileLoader"=None) -> None:
+        """
+        :param data: the (N, h, w, 3) tile buffer
+        :param names: the filename of each tile
+        :param backing: [kind ("shm" or "file"), shared memory name or file path, offset of the mapped array in the file, 
+                         the mapped array] if data is (a part of) an array in shared memory or in a memory-mapped file
+        :param loader: if given, data holds thumbnails of the tiles and the loader reads them at full size
+        """
+        self.data = data
+        self.names = np.empty(len(names), dtype=object)
+        self.names[:] = names
+        self.backing = backing
+        self.loader = loader
+        self.mips = {0: data} # the tiles shrunk by powers of 2, computed on demand
+        self.features = {} # block features by block size and colorspace, see MosaicCommon.block_features
+        self.sort_keys = {} # sort keys by sort method, see sort_keys
+        self.cache_folder = "" # the folder of the TileCache the tiles come from, if any
+        self.cache_rows = None # the row of each tile in the TileCache, which is also its row in the FeatureCache
+        assert len(self.data) == len(self.names)
+
+    @property
+    def shape(self) -> Tuple[int, int, int, int]:
+        return self.data.shape
+
+    @property
+    def tile_shape(self) -> Tuple[int, int, int]:
+        """
+        the shape of a tile in the output, which differs from the shape of data if the tiles are thumbnails
+        """
+        return self.loader.tile_shape if self.loader is not None else self.data.shape[1:]
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return InfoArray(self.data[idx], self.names[idx])
+        data = self.data[idx]
+        # slicing returns a view of the same buffer, while gathering by indices makes a copy
+        return self._derived(TileSet(data, self.names[idx], self.backing if isinstance(idx, slice) else None, self.loader), idx)
+
+    def _derived(self, other: "TileSet", idx=slice(None)) -> "TileSet":
+        """
+        :param idx: the tiles of self that other holds
+        """
+        if self.cache_rows is not None:
+            other.cache_folder = self.cache_folder
+            other.cache_rows = self.cache_rows[idx]
+        return other
+
+    def mip(self, level: int) -> np.ndarray:
+        """
+        the tiles shrunk by 2^level with area averaging. The tile size must be a multiple of 2^level, so that every 
+        pixel of the level averages exactly a 2^level x 2^level block of the tiles
+        """
+        if level not in self.mips:
+            th, tw = self.shape[1:3]
+            assert th % (1 << level) == 0 and tw % (1 << level) == 0
+            # computed from the full size tiles rather than the previous level, so that rounding errors do not add up
+            self.mips[level] = resize_tiles_area(self.data, (tw >> level, th >> level)).round().astype(np.uint8)
+        return self.mips[level]
+
+    def resize_area(self, size: Tuple[int, int]) -> np.ndarray:
+        """
+        shrink all tiles to size = (width, height) with area averaging, like cv2.resize with cv2.INTER_AREA. 
+        (Before, each tile was resized with the bilinear cv2.resize, which skips pixels when shrinking a lot.)
+
+        When the tile size is a multiple of 2^level times size, every output pixel covers whole pixels of mip level 
+        level, and the result is computed from that level instead of the full size tiles, so that computing features 
+        for different block sizes does not go through the full size tiles every time. The only difference from 
+        cv2.INTER_AREA is then the rounding of the mip level, which is within 0.5/255. Otherwise, a pixel of a mip 
+        level could be partly covered by an output pixel, so the full size tiles are used and the result is exact
+
+        :return: float32 array of shape (N, height, width, 3)
+        """
+        w, h = size
+        th, tw = self.shape[1:3]
+        level = 0
+        if tw % w == 0 and th % h == 0:
+            while (tw // w) % (2 << level) == 0 and (th // h) % (2 << level) == 0:
+                level += 1
+        return resize_tiles_area(self.mip(level), size)
+
+    def copy(self) -> "TileSet":
+        return self._derived(TileSet(self.data.copy(), self.names.copy(), loader=self.loader))
+
+    def take(self, idx: np.ndarray) -> "TileSet":
+        """
+        gather the tiles at idx into a new buffer in shared memory, so that the result can still be pickled cheaply
+        """
+        if len(idx) == 0:
+            return self[idx]
+        name, buf = alloc_shared_tiles((len(idx), *self.shape[1:]))
+        np.take(self.data, idx, axis=0, out=buf)
+        return self._derived(TileSet(buf, self.names[idx], ("shm", name, 0, buf), self.loader), idx)
+
+    def __reduce__(self):
+        # mip levels and features in memory are not sent. With a tile cache, the receiver maps the features from 
+        # the feature cache, otherwise it computes them again
+        state = {"loader": self.loader, "cache_folder": self.cache_folder, "cache_rows": self.cache_rows}
+        if self.backing is not None and self.data.flags.c_contiguous:
+            kind, name, file_offset, mapped = self.backing
+            offset = self.data.ctypes.data - mapped.ctypes.data
+            if 0 <= offset and offset + self.data.nbytes <= mapped.nbytes:
+                return _open_tileset, (kind, name, file_offset + offset, self.data.shape, self.names), state
+        return TileSet, (self.data, self.names), state
+
+
+def area_weights(n_src: int, n_dst: int) -> np.ndarray:
+    """
+    :return: (n_dst, n_src) matrix whose row i holds the fraction of output pixel i covered by each input pixel
+    """
+    scale = n_src / n_dst
+    lo = np.arange(n_dst)[:, None] * scale
+    j = np.arange(n_src)[None, :]
+    overlap = np.minimum(lo + scale, j + 1) - np.maximum(lo, j)
+    return (np.clip(overlap, 0, None) / scale).astype(np.float32)
+
+
+def resize_tiles_area(tiles: np.ndarray, size: Tuple[int, int], chunk_bytes=2**26) -> np.ndarray:
+    """
+    resize all (N, h, w, c) tiles to size = (width, height) with area averaging, as two matrix products over the whole set
+
+    :return: float32 array of shape (N, height, width, c)
+    """
+    n, h, w, c = tiles.shape
+    rx = area_weights(w, size[0])
+    ry = area_weights(h, size[1])
+    out = np.empty((n, size[1], size[0], c), dtype=np.float32)
+    chunk_size = max(1, chunk_bytes // (h * w * c * 4))
+    for start in range(0, n, chunk_size):
+        chunk = tiles[start:start + chunk_size].astype(np.float32)
+        # (k, h, w, c) -> (k, c, h, w) so that both axes can be reduced by matmul
+        chunk = ry @ chunk.transpose(0, 3, 1, 2) @ rx.T
+        out[start:start + chunk_size] = chunk.transpose(0, 2, 3, 1)
+    return out
+
+
+def _open_tileset(kind: str, name: str, offset: int, shape: Tuple[int, int, int, int], names: np.ndarray) -> TileSet:
+    if kind == "shm":
+        mapped = open_shared_tiles(name)
+        data = np.ndarray(shape, dtype=np.uint8, buffer=mapped, offset=offset)
+        return TileSet(data, names, (kind, name, 0, mapped))
+    mapped = np.memmap(name, dtype=np.uint8, mode="r", offset=offset, shape=shape)
+    return TileSet(mapped, names, (kind, name, offset, mapped))
+
 cupy_available = False
 
 
@@ -176,178 +395,709 @@ def to_cpu(X: np.ndarray) -> np.ndarray:
     return X.get() if cupy_available else X
 
 
-def bgr_sum(img: np.ndarray) -> float:
+# The sort keys below take a batch of tiles of shape (N, h, w, 3) and return one key per tile
+
+
+def bgr_sum(imgs: np.ndarray) -> np.ndarray:
     """
-    compute the sum of all RGB values across an image
+    compute the sum of all RGB values across each image
     """
-    return np.sum(img)
+    return imgs.reshape(len(imgs), -1).sum(axis=1, dtype=np.uint64)
 
 
-def av_hue(img: np.ndarray) -> float:
+def _hsv_channel_mean(imgs: np.ndarray, channel: int) -> np.ndarray:
+    # the hue and saturation of the mean color are not the means of the hue and saturation, 
+    # so all pixels are converted, in one call for the whole batch
+    n, h, w, _ = imgs.shape
+    hsv = cv2.cvtColor(np.ascontiguousarray(imgs).reshape(n * h, w, 3), cv2.COLOR_BGR2HSV)
+    return hsv[:, :, channel].reshape(n, -1).mean(axis=1)
+
+
+def av_hue(imgs: np.ndarray) -> np.ndarray:
     """
     compute the average hue of all pixels in HSV color space
     """
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    return np.mean(hsv[:, :, 0])
+    return _hsv_channel_mean(imgs, 0)
 
 
-def av_sat(img: np.ndarray) -> float:
+def av_sat(imgs: np.ndarray) -> np.ndarray:
     """
     compute the average saturation of all pixels in HSV color space
     """
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    return np.mean(hsv[:, :, 1])
+    return _hsv_channel_mean(imgs, 1)
 
 
-lum_coeffs = np.array([0.241, 0.691, 0.068], dtype=np.float32)[np.newaxis, np.newaxis, :]
+lum_coeffs = np.array([0.241, 0.691, 0.068], dtype=np.float32)
+# sqrt(coeff * value) of every channel value, as the square root does not commute with the mean
+lum_lut = np.sqrt(np.arange(256, dtype=np.float32)[:, np.newaxis] * lum_coeffs)[np.newaxis]
 
 
-def av_lum(img) -> float:
+def av_lum(imgs: np.ndarray) -> np.ndarray:
     """
     compute the average luminosity
     """
-    lum = img * lum_coeffs
-    np.sqrt(lum, out=lum)
-    return np.mean(lum)
+    n, h, w, _ = imgs.shape
+    lum = cv2.LUT(np.ascontiguousarray(imgs).reshape(n * h, w, 3), lum_lut)
+    return lum.reshape(n, -1).mean(axis=1)
+
+
+def lab_mean(imgs: np.ndarray) -> np.ndarray:
+    """
+    compute the average color of each image in CIELAB, with L in [0, 100] and a, b in [-128, 127]
+    """
+    n, h, w, _ = imgs.shape
+    lab = cv2.cvtColor(np.ascontiguousarray(imgs).reshape(n * h, w, 3), cv2.COLOR_BGR2LAB)
+    return (lab.reshape(n, -1, 3).mean(axis=1) - [0, 128, 128]) * [100 / 255, 1, 1]
 
 
-def rand(img: np.ndarray) -> float:
+def rand(imgs: np.ndarray) -> np.ndarray:
     """
     generate a random number for each image
     """
-    return random.random()
+    return np.random.random(len(imgs))
 
 
-def calc_grid_size(rw: int, rh: int, num_imgs: int, shape: Tuple[int, int, int]) -> Grid:
+# keys with several values per tile are ordered by their first principal component
+SORT_KEYS = {"pca_lab": lab_mean, "bgr_sum": bgr_sum, "av_hue": av_hue, "av_sat": av_sat, "av_lum": av_lum, "rand": rand}
+SORT_CHUNK_BYTES = 2**26
+
+
+def _sort_keys_chunk(imgs: TileSet, sort_method: str) -> np.ndarray:
+    key_func = SORT_KEYS[sort_method]
+    chunk_size = max(1, SORT_CHUNK_BYTES // int(np.prod(imgs.shape[1:])))
+    return np.concatenate([key_func(imgs.data[i:i + chunk_size]) for i in range(0, len(imgs), chunk_size)])
+
+
+def _compute_keys(imgs: TileSet, sort_method: str, pool: mp.Pool=None) -> np.ndarray:
+    chunk_size = max(1, SORT_CHUNK_BYTES // int(np.prod(imgs.shape[1:])))
+    if pool is None or len(imgs) <= chunk_size:
+        return _sort_keys_chunk(imgs, sort_method)
+    # slices of a tile set are pickled without their tiles if they are in shared memory or in a file
+    chunks = [(imgs[i:i + chunk_size], sort_method) for i in range(0, len(imgs), chunk_size)]
+    return np.concatenate(pool.starmap(_sort_keys_chunk, chunks))
+
+
+def tile_keys(imgs: TileSet, sort_method: str, pool: mp.Pool=None) -> np.ndarray:
+    """
+    compute the sort key of every tile. The tiles are split into chunks, which are sent to the pool if there are many.
+    Keys other than rand are cached in the tile set, and in the feature cache if the tiles come from a tile cache, 
+    so that only the keys of new tiles are computed in the next run
+    """
+    keys = imgs.sort_keys.get(sort_method)
+    if keys is not None:
+        return keys
+    if sort_method == "rand":
+        return _compute_keys(imgs, sort_method, pool)
+    if imgs.cache_rows is not None and len(imgs) > 0:
+        # the number of values of a key, e.g. 3 for the average color
+        length = _sort_keys_chunk(imgs[:1], sort_method).reshape(1, -1).shape[1]
+
+        def compute(idx: np.ndarray) -> np.ndarray:
+            # the tiles are gathered into shared memory, so that they are still sent cheaply to the pool
+            keys = _compute_keys(imgs if len(idx) == len(imgs) else imgs.take(idx), sort_method, pool)
+            return keys.reshape(len(idx), length).T
+
+        keys = FeatureCache(imgs.cache_folder).load(f"sort-{sort_method}", imgs.cache_rows, length, compute, np.float64)
+        keys = keys[0] if length == 1 else keys.T
+    else:
+        keys = _compute_keys(imgs, sort_method, pool)
+    imgs.sort_keys[sort_method] = keys
+    return keys
+
+
+def principal_components(x: np.ndarray, k: int) -> np.ndarray:
+    """
+    project the rows of x onto their first k principal components. 
+    The components are oriented to increase with the first column of x, e.g. from dark to light for LAB colors
+    """
+    x = x - x.mean(axis=0)
+    _, vecs = np.linalg.eigh(x.T @ x)
+    vecs = vecs[:, ::-1][:, :k]
+    vecs = vecs * np.where(vecs[0] < 0, -1, 1)
+    return x @ vecs
+
+
+GRADIENT_BLOCK = 16
+GRADIENT_ITERS = 4
+
+
+def gradient_layout(colors: np.ndarray, grid: Grid, block=GRADIENT_BLOCK, iters=GRADIENT_ITERS) -> np.ndarray:
     """
+    Lay out the tiles on the grid so that their colors change smoothly in both directions
+
+    The tiles are first placed by rank: the first principal component of their colors runs along the longer side of 
+    the grid, and the second along the shorter side. The layout is then refined by blurring the colors of the grid 
+    into a target and solving the assignment of tiles to cells against that target within each block of cells. 
+    The blocks are shifted by half a block in every other iteration, so that tiles can move across block borders. 
+    Each assignment is small, so the cost grows linearly with the number of tiles instead of with a dense N x N matrix.
+
+    :param colors: the average color of each tile, of shape (N, 3)
+    :param grid: grid size
+    :param block: the width and height of the blocks that are assigned together
+    :param iters: number of refinement iterations
+    :return: the index of the tile in each cell, in row-major order. Empty cells are -1
+    """
+    gw, gh = grid
+    length, width = max(gw, gh), min(gw, gh)
+    pcs = principal_components(colors, 2)
+    order = np.argsort(pcs[:, 0], kind="stable")
+    # each line across the grid holds the tiles of one rank interval of the first component, sorted by the second
+    layout = np.full((length, width), -1, dtype=np.int64)
+    for i in range(0, len(order), width):
+        line = order[i:i + width]
+        layout[i // width, :len(line)] = line[np.argsort(pcs[line, 1], kind="stable")]
+    if gw > gh:
+        layout = np.ascontiguousarray(layout.T)
+
+    colors = colors.astype(np.float32)
+    filled = layout >= 0
+    weight = cv2.GaussianBlur(filled.astype(np.float32), (0, 0), 1)[:, :, np.newaxis]
+    for it in range(iters):
+        field = np.zeros((gh, gw, 3), dtype=np.float32)
+        field[filled] = colors[layout[filled]]
+        target = cv2.GaussianBlur(field, (0, 0), 1) / np.maximum(weight, 1e-6)
+        offset = block // 2 if it % 2 else 0
+        for y in range(-offset, gh, block):
+            for x in range(-offset, gw, block):
+                ys, xs = slice(max(y, 0), y + block), slice(max(x, 0), x + block)
+                cells = layout[ys, xs]
+                mask = cells >= 0
+                tiles = cells[mask]
+                if len(tiles) < 2:
+                    continue
+                diff = target[ys, xs][mask][:, np.newaxis] - colors[tiles]
+                # the targets of neighbouring cells are nearly equal, which makes lapjv slow to converge on 
+                # floating point costs. Rounding them to integers makes such near ties exact
+                cost = np.rint(np.einsum("ijk,ijk->ij", diff, diff)).astype(np.float64)
+                cost -= cost.min(axis=1, keepdims=True)
+                rows, _, _ = lapjv(cost)
+                cells[mask] = tiles[rows]
+    return layout.ravel()
+
+
+class GridCandidate(NamedTuple):
+    width: int
+    height: int
+    ratio: float # aspect ratio of the collage
+    unused: int # number of empty cells if positive, or number of dropped tiles if negative
+
+
+def grid_candidates(rw: int, rh: int, num_imgs: int, shape: Tuple[int, int, int], spread=1) -> List[GridCandidate]:
+    """
+    Enumerate the grid sizes whose aspect ratio is close to the target ratio
+
+    The aspect ratio of a grid of width w that fits all tiles, w * tw / (th * ceil(num_imgs / w)), increases with w and 
+    lies between w^2 * tw / (th * (num_imgs + w)) and w^2 * tw / (th * num_imgs). The width that best matches the target 
+    ratio is therefore between the widths at which these two bounds equal the target, which are only a few widths apart.
+
     :param rw: the width of the target image
     :param rh: the height of the target image
     :param num_imgs: number of images available
     :param shape: the shape of a tile
-    :return: an optimal grid size
+    :param spread: number of extra widths to include on either side
+    :return: for each width, the grid with enough rows to fit all tiles, followed by the grid that drops the last 
+             partial row if there is one
     """
-    possible_wh = []
     th, tw, _ = shape
-    for width in range(1, num_imgs):
+    dest_ratio = rw / rh
+    k = tw / th
+    lo = math.floor(math.sqrt(num_imgs * dest_ratio / k)) - spread
+    hi = math.ceil((dest_ratio + math.sqrt(dest_ratio ** 2 + 4 * k * dest_ratio * num_imgs)) / (2 * k)) + spread
+    hi = min(hi, max(num_imgs - 1, 1))
+    lo = min(max(lo, 1), hi)
+    candidates = []
+    for width in range(lo, hi + 1):
         height = math.ceil(num_imgs / width)
-        possible_wh.append((width * tw / (th * height), width, height))
+        candidates.append(GridCandidate(width, height, width * tw / (th * height), width * height - num_imgs))
+        if num_imgs % width and height > 1:
+            height -= 1
+            candidates.append(GridCandidate(width, height, width * tw / (th * height), width * height - num_imgs))
+    return candidates
+
+
+def calc_grid_size(rw: int, rh: int, num_imgs: int, shape: Tuple[int, int, int]) -> Grid:
+    """
+    :param rw: the width of the target image
+    :param rh: the height of the target image
+    :param num_imgs: number of images available
+    :param shape: the shape of a tile
+    :return: an optimal grid size that fits all images
+    """
+    th, tw, _ = shape
     dest_ratio = rw / rh
-    grid = min(possible_wh, key=lambda x: (x[0] - dest_ratio) ** 2)[1:]
+    best = min((c for c in grid_candidates(rw, rh, num_imgs, shape) if c.unused >= 0), 
+               key=lambda c: (c.ratio - dest_ratio) ** 2)
+    grid = best.width, best.height
     print("Tile shape:", (tw, th))
     print("Calculated grid size based on the aspect ratio of the destination image:", grid)
     print(f"Collage size will be {grid[0] * tw}x{grid[1] * th}. ")
     return grid
 
 
-def make_collage_helper(grid: Grid, sorted_imgs: ImgList, rev=False, ridx=None, cidx=None, file=None):
+def _grid_assignment(grid: Grid, imgs: TileSet, assignment: np.ndarray, rev=False, ridx=None, cidx=None, file=None):
+    """
+    load the tiles if needed and lay out the assignment on the grid
+
+    :return: [the tiles, the index of the tile in each cell of shape (rows, columns), tile info]
+    """
+    if imgs.loader is not None:
+        imgs, assignment = imgs.loader.load(imgs, assignment, file)
     grid = grid[::-1]
-    th, tw, tc = sorted_imgs[0].shape
-    tile_info = np.full(grid, "background", dtype=str)
+    # index -1 refers to the last name, which is the one of the transparent tile
+    names = np.append(imgs.names, "background")
     if ridx is None or cidx is None:
-        combined_img = np.empty((grid[0] * th, grid[1] * tw, 4), dtype=np.uint8)
-        # use an array of references to avoid copying individual tiles
-        tiles = np.array([None] * len(sorted_imgs), dtype=object)
-        tiles[:] = sorted_imgs
-        tiles.shape = grid
+        assignment = assignment.reshape(grid)
         if rev:
-            tiles[1::2] = tiles[1::2, ::-1]
-        
-        # while we can use a few lines of transpose + reshape to do this, 
-        # we just use an ordinary for loop in order to show the progress
-        for i, j in tqdm(itertools.product(range(grid[0]), range(grid[1])), 
-            desc="[Aligning tiles]", ncols=pbar_ncols, total=np.prod(grid), file=file):
-            tile = tiles[i, j]
-            # if this tile already have an alpha channel, use it
-            if tile.shape[2] == 4:
-                combined_img[i * th:(i + 1)*th, j * tw:(j + 1)*tw] = tile
-            else:
-                combined_img[i * th:(i + 1)*th, j * tw:(j + 1)*tw, :3] = tile
-                combined_img[i * th:(i + 1)*th, j * tw:(j + 1)*tw, 3] = 255
-            tile_info[i, j] = tile.info
+            assignment = assignment.copy()
+            assignment[1::2] = assignment[1::2, ::-1]
     else:
         assert not rev
-        combined_img = np.full((grid[0] * th, grid[1] * tw, 4), [255, 255, 255, 0], dtype=np.uint8)
-        for k in tqdm(range(len(ridx)), desc="[Aligning tiles]", ncols=pbar_ncols, file=file):
-            i = ridx[k]
-            j = cidx[k]
-            combined_img[i * th:(i + 1)*th, j * tw:(j + 1)*tw, :tc] = sorted_imgs[k]
-            combined_img[i * th:(i + 1)*th, j * tw:(j + 1)*tw, 3] = 255
-            tile_info[i, j] = sorted_imgs[k].info
-    return combined_img, f"Grid dimension: {grid[::-1]}\n" + '\n'.join(tile_info.flatten())
+        cells = np.full(grid, -1, dtype=np.int64)
+        cells[ridx, cidx] = assignment
+        assignment = cells
+    tile_info = f"Grid dimension: {grid[::-1]}\n" + '\n'.join(names[assignment].flatten())
+    return imgs, assignment, tile_info
+
+
+def render_row(imgs: TileSet, row: np.ndarray, band: np.ndarray):
+    """
+    render one row of the grid into band, of shape (tile height, columns * tile width, channels). 
+    The band may have 3 channels only if the row has no transparent tiles
+
+    :param row: the index of the tile in each cell of the row, or -1 for a transparent tile
+    """
+    th, tw, tc = imgs.shape[1:]
+    empty = row < 0
+    # the tiles of the row are gathered and transposed into the band in one copy
+    tiles = imgs.data[np.where(empty, 0, row)]
+    tiles[empty] = 255
+    band[:, :, :tc] = tiles.transpose(1, 0, 2, 3).reshape(th, len(row) * tw, tc)
+    if band.shape[2] == 4:
+        band[:, :, 3] = np.repeat(np.where(empty, 0, 255).astype(np.uint8), tw)
+
+
+def canvas_channels(assignment: np.ndarray) -> int:
+    """
+    the number of channels of the canvas: an alpha channel is only needed for transparent tiles
+    """
+    return 4 if (assignment < 0).any() else 3
 
 
-def make_collage(grid: Grid, sorted_imgs: ImgList, rev=False):
+def make_collage_helper(grid: Grid, imgs: TileSet, assignment: np.ndarray, rev=False, ridx=None, cidx=None, file=None, 
+                        progress=True):
     """
     :param grid: grid size
-    :param sorted_imgs: list of images sorted in correct position
+    :param imgs: the tiles
+    :param assignment: the index of the tile to put at each position, or -1 for a transparent tile. 
+                       Positions are the cells of the grid in row major order, or the cells given by ridx and cidx
     :param rev: whether to have opposite alignment for consecutive rows
+    :param progress: whether to show a progress bar over the rows of the grid
+    """
+    imgs, assignment, tile_info = _grid_assignment(grid, imgs, assignment, rev, ridx, cidx, file)
+    th, tw, _ = imgs.shape[1:]
+    combined_img = np.empty((grid[1] * th, grid[0] * tw, canvas_channels(assignment)), dtype=np.uint8)
+    for i in tqdm(range(grid[1]), desc="[Aligning tiles]", ncols=pbar_ncols, file=file, disable=not progress):
+        render_row(imgs, assignment[i], combined_img[i * th:(i + 1) * th])
+    return combined_img, tile_info
+
+
+def resize_rows(img: np.ndarray, size: Tuple[int, int], y0: int, y1: int) -> np.ndarray:
+    """
+    compute rows [y0, y1) of cv2.resize(img, size) without resizing the whole image
+    """
+    w, h = size
+    sh, sw = img.shape[:2]
+    map_x = (np.arange(w, dtype=np.float32) + 0.5) * np.float32(sw / w) - 0.5
+    map_y = (np.arange(y0, y1, dtype=np.float32) + 0.5) * np.float32(sh / h) - 0.5
+    map_x = np.ascontiguousarray(np.broadcast_to(map_x, (y1 - y0, w)))
+    map_y = np.ascontiguousarray(np.broadcast_to(map_y[:, np.newaxis], (y1 - y0, w)))
+    return cv2.remap(img, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+class CollageStreamer:
+    """
+    Render a collage one row of tiles at a time, blend each band with the destination image and write it to a PNG file
+    as soon as it is rendered, so that the memory used is bounded by one band and not by the whole collage.
+
+    It can be called in place of make_collage_helper, but returns no image
+    """
+    ext = ".png"
+
+    def __init__(self, path: str, dest_img: np.ndarray=None, blend_func: BlendFunc=None, alpha=1.0):
+        """
+        :param path: the output PNG file
+        :param dest_img: the destination image to blend with, if any
+        :param blend_func: alpha_blend or brightness_blend
+        :param alpha: the weight of the collage in the blend
+        """
+        if len(path) == 0:
+            path = "result" + self.ext
+        assert os.path.splitext(path)[1].lower() == self.ext, f"The output must be a {self.ext} file"
+        self.path = path
+        self.dest_img = dest_img
+        self.blend_func = blend_func
+        self.alpha = alpha
+
+    def __call__(self, grid: Grid, imgs: TileSet, assignment: np.ndarray, rev=False, ridx=None, cidx=None, file=None, 
+                 progress=True) -> Tuple[None, str]:
+        imgs, assignment, tile_info = _grid_assignment(grid, imgs, assignment, rev, ridx, cidx, file)
+        th, tw, _ = imgs.shape[1:]
+        size = (grid[0] * tw, grid[1] * th)
+        band = np.empty((th, size[0], canvas_channels(assignment)), dtype=np.uint8)
+        print("Saving to", self.path, file=file)
+        with self._writer(*size, band.shape[2]) as writer:
+            for i in tqdm(range(grid[1]), desc="[Writing rows]", ncols=pbar_ncols, file=file, disable=not progress):
+                render_row(imgs, assignment[i], band)
+                out = band
+                if self.dest_img is not None and self.blend_func is not None:
+                    out = self.blend_func(band, resize_rows(self.dest_img, size, i * th, (i + 1) * th), self.alpha, inplace=True)
+                self._write(writer, out)
+        return None, tile_info
+
+    def _writer(self, width: int, height: int, channels: int):
+        return PNGWriter(self.path, width, height, channels, png_level(), threads=ENCODE_THREADS)
+
+    def _write(self, writer, band: np.ndarray):
+        writer.write(cv2.cvtColor(band, cv2.COLOR_BGRA2RGBA if band.shape[2] == 4 else cv2.COLOR_BGR2RGB))
+
+
+class DeepZoomPyramid:
+    """
+    Write an image given a few rows at a time as a Deep Zoom (DZI) pyramid of tiles
+
+    Level max_level holds the image at full size and every level below it is half the size of the one above, down to
+    a single pixel at level 0. Each level keeps only the rows of its current row of tiles: when a row of tiles is 
+    complete it is written out, and the rows it receives are also averaged in 2x2 blocks and passed to the next level. 
+    """
+
+    def __init__(self, path: str, width: int, height: int, tile_size=256, fmt="png"):
+        """
+        :param path: the .dzi file. The tiles are written to the folder {name}_files next to it
+        :param fmt: the image format of the tiles
+        """
+        self.path = path
+        self.folder = os.path.splitext(path)[0] + "_files"
+        self.tile_size = tile_size
+        self.fmt = fmt
+        self.width = width
+        self.height = height
+        max_level = math.ceil(math.log2(max(width, height, 1)))
+        self.levels = []
+        for level in range(max_level, -1, -1):
+            scale = 2 ** (max_level - level)
+            self.levels.append({"level": level, "width": -(-width // scale), "height": -(-height // scale), 
+                                "rows": [], "num_rows": 0, "tile_row": 0, "carry": None})
+            os.makedirs(os.path.join(self.folder, str(level)), exist_ok=True)
+
+    def write(self, rows: np.ndarray):
+        """
+        :param rows: the next rows of the image in BGR or BGRA order, of shape (n, width, channels)
+        """
+        self._push(0, rows.copy())
+
+    def _push(self, i: int, rows: np.ndarray):
+        lvl = self.levels[i]
+        lvl["rows"].append(rows)
+        lvl["num_rows"] += len(rows)
+        if lvl["num_rows"] >= self.tile_size:
+            buf = np.concatenate(lvl["rows"])
+            while len(buf) >= self.tile_size:
+                self._write_tiles(lvl, buf[:self.tile_size])
+                buf = buf[self.tile_size:]
+            lvl["rows"], lvl["num_rows"] = [buf], len(buf)
+
+        if i + 1 < len(self.levels):
+            if lvl["carry"] is not None:
+                rows = np.concatenate([lvl["carry"], rows])
+            even = len(rows) - len(rows) % 2
+            lvl["carry"] = rows[even:] if even < len(rows) else None
+            if even > 0:
+                self._push(i + 1, self._halve(rows[:even]))
+
+    @staticmethod
+    def _halve(rows: np.ndarray) -> np.ndarray:
+        """
+        average each 2x2 block of pixels. An odd last column or row is paired with itself
+        """
+        if rows.shape[1] % 2:
+            rows = np.concatenate([rows, rows[:, -1:]], axis=1)
+        if len(rows) % 2:
+            rows = np.concatenate([rows, rows[-1:]])
+        n, w, c = rows.shape
+        blocks = rows.reshape(n // 2, 2, w // 2, 2, c).sum(axis=(1, 3), dtype=np.uint16)
+        return ((blocks + 2) // 4).astype(np.uint8)
+
+    def _write_tiles(self, lvl: dict, rows: np.ndarray):
+        for col, x in enumerate(range(0, lvl["width"], self.tile_size)):
+            tile = rows[:, x:x + self.tile_size]
+            if self.fmt != "png":
+                tile = strip_alpha(tile)
+            imwrite(os.path.join(self.folder, str(lvl["level"]), f"{col}_{lvl['tile_row']}.{self.fmt}"), tile)
+        lvl["tile_row"] += 1
+
+    def close(self):
+        for i, lvl in enumerate(self.levels):
+            if lvl["carry"] is not None and i + 1 < len(self.levels):
+                self._push(i + 1, self._halve(lvl["carry"]))
+                lvl["carry"] = None
+            if lvl["num_rows"] > 0:
+                self._write_tiles(lvl, np.concatenate(lvl["rows"]))
+                lvl["rows"], lvl["num_rows"] = [], 0
+            assert lvl["tile_row"] == -(-lvl["height"] // self.tile_size)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{self.fmt}" Overlap="0" '
+                    f'TileSize="{self.tile_size}">\n'
+                    f'  <Size Width="{self.width}" Height="{self.height}"/>\n'
+                    '</Image>\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+
+
+class DZIWriter(CollageStreamer):
+    """
+    Render a collage one row of tiles at a time into a Deep Zoom (DZI) pyramid, which can be viewed with zoomable
+    image viewers such as OpenSeadragon. The full-size collage is never held in memory. 
+
+    It can be called in place of make_collage_helper, but returns no image
+    """
+    ext = ".dzi"
+
+    def __init__(self, path: str, dest_img: np.ndarray=None, blend_func: BlendFunc=None, alpha=1.0, 
+                 tile_size=256, fmt="png"):
+        """
+        :param path: the output .dzi file
+        :param tile_size: the width and height of the tiles of the pyramid
+        :param fmt: the image format of the tiles of the pyramid
+        """
+        super().__init__(path, dest_img, blend_func, alpha)
+        self.tile_size = tile_size
+        self.fmt = fmt
+
+    def _writer(self, width: int, height: int, channels: int):
+        return DeepZoomPyramid(self.path, width, height, self.tile_size, self.fmt)
+
+    def _write(self, writer, band: np.ndarray):
+        writer.write(band)
+
+
+MANIFEST_VERSION = 1
+
+
+def save_manifest(path: str, grid: Grid, imgs: TileSet, assignment: np.ndarray, rev=False, ridx=None, cidx=None, 
+                  resize_opt="center", auto_rotate=0):
+    """
+    Save the layout of a collage/photomosaic to a .npz manifest, from which it can be rendered again by render_manifest
+    without recomputing the assignment. Only the absolute paths of the tiles that are used are stored
+
+    :param assignment: see make_collage_helper
+    """
+    valid = assignment >= 0
+    used, inverse = np.unique(assignment[valid], return_inverse=True)
+    tiles = np.full(len(assignment), -1, dtype=np.int32)
+    tiles[valid] = inverse
+    masked = ridx is not None and cidx is not None
+    th, tw, _ = imgs.tile_shape
+    # absolute paths, so that the manifest can be rendered from any working directory. 
+    # Only the archive part of the name of an archive member (archive::member) is a path
+    names = []
+    for name in imgs.names[used]:
+        archive, sep, member = name.partition("::")
+        names.append(os.path.abspath(archive) + sep + member)
+    np.savez_compressed(
+        path, version=MANIFEST_VERSION, grid=np.array(grid, dtype=np.int32), assignment=tiles, rev=rev, 
+        ridx=np.asarray(ridx if masked else [], dtype=np.int32), cidx=np.asarray(cidx if masked else [], dtype=np.int32),
+        masked=masked, names=np.array(names, dtype=str), tile_size=np.array([tw, th], dtype=np.int32), 
+        resize_opt=resize_opt, auto_rotate=auto_rotate)
+
+
+class ManifestRecorder:
+    """
+    Save the manifest of a collage/photomosaic, then render it with another renderer. 
+    It can be called in place of make_collage_helper
+    """
+
+    def __init__(self, path: str, renderer=make_collage_helper, resize_opt="center", auto_rotate=0):
+        self.path = path
+        self.renderer = renderer
+        self.resize_opt = resize_opt
+        self.auto_rotate = auto_rotate
+
+    def __call__(self, grid: Grid, imgs: TileSet, assignment: np.ndarray, rev=False, ridx=None, cidx=None, file=None, 
+                 progress=True):
+        save_manifest(self.path, grid, imgs, assignment, rev, ridx, cidx, self.resize_opt, self.auto_rotate)
+        print("Manifest saved to", self.path, file=file)
+        return self.renderer(grid, imgs, assignment, rev, ridx, cidx, file=file, progress=progress)
+
+
+def render_manifest(path: str, img_size: List[int]=(), renderer=make_collage_helper, file=None, num_workers: int=None):
+    """
+    Render a collage/photomosaic from a manifest saved by save_manifest. Only the tiles it uses are decoded
+
+    :param img_size: the tile width and height, or the tile width only with the height following the aspect ratio of the 
+                     tiles in the manifest. Defaults to the tile size the manifest was made with
+    :param num_workers: the number of threads decoding the tiles, by default the number of CPUs
+    :return: the output of the renderer
+    """
+    with np.load(path) as m:
+        assert int(m["version"]) == MANIFEST_VERSION, f"Unsupported manifest version {int(m['version'])}"
+        grid = tuple(int(x) for x in m["grid"])
+        assignment = m["assignment"].astype(np.int64)
+        ridx, cidx = (m["ridx"], m["cidx"]) if bool(m["masked"]) else (None, None)
+        names = [str(name) for name in m["names"]]
+        tw, th = (int(x) for x in m["tile_size"])
+        flag, auto_rotate, rev = str(m["resize_opt"]), int(m["auto_rotate"]), bool(m["rev"])
+    if len(img_size) == 0:
+        img_size = (tw, th)
+    elif len(img_size) == 1:
+        img_size = (img_size[0], max(1, round(img_size[0] * th / tw)))
+    print("Rendering", path, "with tile size", tuple(img_size), file=file)
+
+    read_img = read_img_other
+    if flag == "center":
+        read_img = read_img_center
+    if flag == "fit":
+        read_img = read_img_fit
+    # tiles read from an archive are named archive::member
+    archive = names[0].split("::")[0] if len(names) > 0 and "::" in names[0] else None
+    if archive is not None and not is_archive(archive):
+        archive = None
+    assert archive is not None or any(os.path.isfile(name) for name in names), \
+        f"None of the {len(names)} tiles of the manifest {path} exist"
+    # the loader decodes the tiles at their final size, and renders tiles that cannot be read as white
+    placeholders = TileSet(np.full((len(names), 1, 1, 3), 255, dtype=np.uint8), np.array(names, dtype=object), 
+                           loader=TileLoader(tuple(img_size), read_img, auto_rotate, archive, num_workers))
+    return renderer(grid, placeholders, assignment, rev, ridx, cidx, file=file)
+
+
+def make_collage(grid: Grid, imgs: TileSet, rev=False, order: np.ndarray=None, renderer=make_collage_helper):
+    """
+    :param grid: grid size
+    :param imgs: the tiles
+    :param rev: whether to have opposite alignment for consecutive rows
+    :param order: indices of the tiles in the order they should be placed. Defaults to the order of imgs
+    :param renderer: make_collage_helper, or a CollageStreamer to write the collage while it is rendered
     :return: a collage
     """
     total = np.prod(grid)
-    diff = total - len(sorted_imgs)
+    assignment = np.arange(len(imgs)) if order is None else order
+    diff = total - len(assignment)
     if diff > 0:
         print(f"Note: {diff} transparent tiles will be added to the grid.")
-        sorted_imgs.extend([InfoArray(
-            np.full((*sorted_imgs[0].shape[:2], 4), [255, 255, 255, 0], dtype=np.uint8), 'background')] * diff)
-    elif len(sorted_imgs) > total:
-        print(f"Note: {len(sorted_imgs) - total} tiles will be dropped from the grid.")
-        del sorted_imgs[total:]
-    return make_collage_helper(grid, sorted_imgs, rev)
+        assignment = np.concatenate([assignment, np.full(diff, -1, dtype=assignment.dtype)])
+    elif len(assignment) > total:
+        print(f"Note: {len(assignment) - total} tiles will be dropped from the grid.")
+        assignment = assignment[:total]
+    return renderer(grid, imgs, assignment, rev)
 
 
-def alpha_blend(combined_img: np.ndarray, dest_img: np.ndarray, alpha=0.9):
+BLEND_BAND_BYTES = 2**24 # size of the bands of rows a collage is blended in
+
+
+def _blend_bands(combined_img: np.ndarray, dest_img: np.ndarray, inplace: bool, 
+                 blend_band: Callable[[slice, np.ndarray, np.ndarray], None]) -> np.ndarray:
+    """
+    call blend_band(rows, dest_band, out_band) on bands of rows of the collage, with the same rows of the destination 
+    image resized to the size of the collage and of the output, so that the temporaries of the blend are never larger 
+    than one band
+    """
+    out = combined_img if inplace else np.empty_like(combined_img)
+    h, w, c = combined_img.shape
+    band_rows = max(1, BLEND_BAND_BYTES // (w * c))
+    for y0 in range(0, h, band_rows):
+        y1 = min(h, y0 + band_rows)
+        blend_band(slice(y0, y1), resize_rows(dest_img, (w, h), y0, y1), out[y0:y1])
+    return out
+
+
+def alpha_blend(combined_img: np.ndarray, dest_img: np.ndarray, alpha=0.9, inplace=False):
+    """
+    :param inplace: write the result to combined_img instead of a new image
+    """
     if alpha == 1.0:
         return combined_img
-    if dest_img.shape[2] == 4:
-        dest_img = cv2.cvtColor(dest_img, cv2.COLOR_BGRA2BGR)
-    dest_img = dest_img * np.float32(1 - alpha)
-    dest_img = cv2.resize(dest_img, combined_img.shape[1::-1])
-    combined_img = combined_img * np.array([alpha, alpha, alpha, 1], dtype=np.float32).reshape(1, 1, 4)
-    combined_img[:, :, :3] += dest_img
-    return combined_img.astype(np.uint8)
+    dest_img = strip_alpha(dest_img)
 
+    # addWeighted rounds to the nearest integer. Subtracting 0.5 truncates like the float blend did
+    def blend_band(rows: slice, dest_band: np.ndarray, out: np.ndarray):
+        band = combined_img[rows]
+        if band.shape[2] == 3:
+            cv2.addWeighted(band, alpha, dest_band, 1 - alpha, -0.5, dst=out)
+            return
+        out[:, :, :3] = cv2.addWeighted(band[:, :, :3], alpha, dest_band, 1 - alpha, -0.5)
+        out[:, :, 3] = band[:, :, 3]
+
+    return _blend_bands(combined_img, dest_img, inplace, blend_band)
 
-def brightness_blend(combined_img: np.ndarray, dest_img: np.ndarray, alpha=0.9):
+
+def brightness_blend(combined_img: np.ndarray, dest_img: np.ndarray, alpha=0.9, inplace=False, 
+                     combined_hls: np.ndarray=None):
     """
     blend the 2 imgs in the lightness channel (L in HSL)
+
+    :param inplace: write the result to combined_img instead of a new image
+    :param combined_hls: combined_img converted to HLS, if it is already known, e.g. when the same collage is blended 
+                         at several alphas
     """
     if alpha == 1.0:
         return combined_img
-    if dest_img.shape[2] == 4:
-        dest_img = cv2.cvtColor(dest_img, cv2.COLOR_BGRA2BGR)
-    dest_img = cv2.cvtColor(dest_img, cv2.COLOR_BGR2HLS)
-    dest_l = dest_img[:, :, 1] * np.float32(1 - alpha)
-    dest_l = cv2.resize(dest_l, combined_img.shape[1::-1])
-    combined_img_hls = cv2.cvtColor(combined_img[:, :, :3], cv2.COLOR_BGR2HLS)
-    comb_l = combined_img_hls[:, :, 1] * np.float32(alpha)
-    comb_l += dest_l
-    combined_img_hls[:, :, 1] = comb_l
-    combined_img = combined_img.copy()
-    combined_img[:, :, :3] = cv2.cvtColor(combined_img_hls, cv2.COLOR_HLS2BGR)
-    return combined_img
-
-
-def sort_collage(imgs: ImgList, ratio: Grid, sort_method="pca_lab", rev_sort=False) -> Tuple[Grid, np.ndarray]:
-    """
-    :param imgs: list of images
+    dest_l = cv2.cvtColor(strip_alpha(dest_img), cv2.COLOR_BGR2HLS)[:, :, 1].copy()
+
+    def blend_band(rows: slice, dest_band: np.ndarray, out: np.ndarray):
+        band = combined_img[rows]
+        if combined_hls is None:
+            band_hls = cv2.cvtColor(band[:, :, :3], cv2.COLOR_BGR2HLS)
+        else:
+            band_hls = combined_hls[rows].copy()
+        band_hls[:, :, 1] = cv2.addWeighted(band_hls[:, :, 1], alpha, dest_band, 1 - alpha, -0.5)
+        if band.shape[2] == 3:
+            cv2.cvtColor(band_hls, cv2.COLOR_HLS2BGR, dst=out)
+            return
+        out[:, :, :3] = cv2.cvtColor(band_hls, cv2.COLOR_HLS2BGR)
+        out[:, :, 3] = band[:, :, 3]
+
+    return _blend_bands(combined_img, dest_l, inplace, blend_band)
+
+
+def sort_collage(imgs: TileSet, ratio: Grid, sort_method="pca_lab", rev_sort=False, layout="rows", 
+                 pool: mp.Pool=None) -> Tuple[Grid, np.ndarray]:
+    """
+    :param imgs: the tiles
     :param ratio: The aspect ratio of the collage
-    :param sort_method:
+    :param sort_method: "none" or one of SORT_KEYS. Not used by the gradient layout
     :param rev_sort: whether to reverse the sorted array
-    :return: [calculated grid size, sorted image array]
+    :param layout: rows: place the sorted tiles row by row. gradient: place the tiles along a 2D color gradient
+    :param pool: if given, used to compute the sort keys of large tile sets
+    :return: [calculated grid size, indices of the tiles in sorted order]
     """
     t = time.time()
-    grid = calc_grid_size(ratio[0], ratio[1], len(imgs), imgs[0].shape)
+    grid = calc_grid_size(ratio[0], ratio[1], len(imgs), imgs.tile_shape)
+
+    if layout == "gradient":
+        print("Computing gradient layout...")
+        indices = gradient_layout(tile_keys(imgs, "pca_lab", pool), grid)
+        if rev_sort:
+            indices = indices[::-1]
+        print("Time taken: {}s".format(np.round(time.time() - t, 2)))
+        return grid, indices
 
     if sort_method == "none":
-        return grid, imgs
+        return grid, np.arange(len(imgs))
 
     print("Sorting images...")    
-    sort_function = eval(sort_method)
-    indices = np.array(list(map(sort_function, imgs))).argsort()
+    keys = tile_keys(imgs, sort_method, pool)
+    if keys.ndim == 2:
+        keys = principal_components(keys, 1)[:, 0]
+    indices = keys.argsort()
     if rev_sort:
         indices = indices[::-1]
     print("Time taken: {}s".format(np.round(time.time() - t, 2)))
-    return grid, [imgs[i] for i in indices]
+    return grid, indices
 
 
 def solve_lap(cost_matrix: np.ndarray, v=-1):
@@ -404,26 +1154,24 @@ def compute_block_map(thresh_map: np.ndarray, block_width: int, block_height: in
     return row_idx, col_idx, thresh_map
 
 
-def dup_to_meet_total(imgs: ImgList, total: int):
+def dup_to_meet_total(num_imgs: int, total: int) -> np.ndarray:
     """
-    note that this function modifies imgs in place
+    :return: indices of the tiles to use, so that every tile is used (almost) equally often to fill total positions
     """
-    orig_len = len(imgs)
-    if total < orig_len:
-        print(f"{total} tiles will be used 1 time. {orig_len - total}/{orig_len} tiles will not be used. ")
-        del imgs[total:]
-        return imgs
+    if total < num_imgs:
+        print(f"{total} tiles will be used 1 time. {num_imgs - total}/{num_imgs} tiles will not be used. ")
+        return np.arange(total)
     
-    full_count = total // orig_len
-    remaining = total % orig_len
+    full_count = total // num_imgs
+    remaining = total % num_imgs
 
-    imgs *= full_count
+    indices = np.tile(np.arange(num_imgs), full_count)
     if remaining > 0:
-        print(f"{orig_len - remaining} tiles will be used {full_count} times. {remaining} tiles will be used {full_count + 1} times. Total tiles: {orig_len}.")
-        imgs.extend(imgs[:remaining])
+        print(f"{num_imgs - remaining} tiles will be used {full_count} times. {remaining} tiles will be used {full_count + 1} times. Total tiles: {num_imgs}.")
+        indices = np.concatenate([indices, np.arange(remaining)])
     else:
-        print(f"Total tiles: {orig_len}. All of them will be used {full_count} times.")
-    return imgs
+        print(f"Total tiles: {num_imgs}. All of them will be used {full_count} times.")
+    return indices
 
 
 def _cosine(A, B):
@@ -460,15 +1208,19 @@ def thresh_map_transp(dest_img: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
 
 
 class CachedCDist:
-    def __init__(self, metric: str, B: np.ndarray):
+    def __init__(self, metric: str, B: np.ndarray, norms: np.ndarray=None):
         """
         Simple implementation of scipy.spatial.distance.cdist
+
+        :param norms: if given, the precomputed L2 norms (norms[0]) and squared L2 norms (norms[1]) of the rows of B
         """
         if metric == "cosine":
-            self.args = [B / cp.linalg.norm(B, axis=1, keepdims=True)]
+            norm = cp.linalg.norm(B, axis=1, keepdims=True) if norms is None else norms[0][:, cp.newaxis]
+            self.args = [B / norm]
             self.func = _cosine
         elif metric == "euclidean":
-            self.args = [B, cp.sum(B**2, axis=1, keepdims=True).T]
+            sq = cp.sum(B**2, axis=1, keepdims=True).T if norms is None else norms[1][cp.newaxis, :]
+            self.args = [B, sq]
             self.func = _euclidean
         else:
             row_stride = LIMIT // (B.size * 4)
@@ -486,8 +1238,17 @@ class CachedCDist:
 
 
 class MosaicCommon:
-    def __init__(self, imgs: ImgList, colorspace="lab") -> None:
+    def __init__(self, imgs: TileSet, colorspace="lab", tile_idx: np.ndarray=None) -> None:
+        """
+        :param imgs: the tiles
+        :param tile_idx: if given, the tiles available for assignment are imgs[tile_idx]. 
+                         This is used to duplicate tiles without copying them
+        """
         self.imgs = imgs
+        self.tile_idx = tile_idx
+        self.colorspace = colorspace
+        # make_collage_helper, or a CollageStreamer to write the photomosaic while it is rendered
+        self.renderer = make_collage_helper
         self.normalize_first = False
         if colorspace == "bgr":
             self.flag = None
@@ -505,10 +1266,14 @@ class MosaicCommon:
             raise ValueError("Unknown colorspace " + colorspace)
 
     def make_photomosaic(self, assignment: np.ndarray, file=None):
-        return make_collage_helper(self.grid, [self.imgs[i] for i in assignment], file=file)
+        if self.tile_idx is not None:
+            assignment = self.tile_idx[assignment]
+        return self.renderer(self.grid, self.imgs, assignment, file=file)
 
     def make_photomosaic_mask(self, assignment: np.ndarray, ridx: np.ndarray, cidx: np.ndarray, file=None):
-        return make_collage_helper(self.grid, [self.imgs[i] for i in assignment], False, ridx, cidx, file=file)
+        if self.tile_idx is not None:
+            assignment = self.tile_idx[assignment]
+        return self.renderer(self.grid, self.imgs, assignment, False, ridx, cidx, file=file)
 
     def convert_colorspace(self, img: np.ndarray):
         if self.flag is None:
@@ -535,16 +1300,50 @@ class MosaicCommon:
         self.target_sz = (grid[0] * self.block_width, grid[1] * self.block_height)
         print(f"Resizing dest image from {dest_shape[1]}x{dest_shape[0]} to {self.target_sz[0]}x{self.target_sz[1]}")
 
+    def block_features(self) -> np.ndarray:
+        """
+        Compute the block features of the tiles, or get them from the cache of the tile set.
+
+        :return: float32 array of shape (flat_block_size + 2, N). Column i holds the features of tile i, 
+                 followed by their L2 norm and squared L2 norm. 
+                 This layout makes the features (the transpose of the first rows) usable by matmul without copying
+        """
+        key = f"{self.block_width}x{self.block_height}-{self.colorspace}"
+        features = self.imgs.features.get(key)
+        if features is not None:
+            return features
+
+        def compute(idx: np.ndarray) -> np.ndarray:
+            imgs = self.imgs if len(idx) == len(self.imgs) else self.imgs[idx]
+            img_keys = imgs.resize_area((self.block_width, self.block_height))
+            img_keys.shape = (-1, self.block_width, 3)
+            img_keys *= np.float32(1 / 255.0)
+            self.convert_colorspace(img_keys)
+            img_keys.shape = (-1, self.flat_block_size)
+            features = np.empty((self.flat_block_size + 2, len(img_keys)), dtype=np.float32)
+            features[:-2] = img_keys.T
+            features[-2] = np.linalg.norm(img_keys, axis=1)
+            features[-1] = np.sum(img_keys**2, axis=1)
+            return features
+
+        if self.imgs.cache_rows is not None:
+            # only the tiles that are new to the tile cache are computed. The features are mapped from the cache file, 
+            # so the worker processes given these tiles share them
+            features = FeatureCache(self.imgs.cache_folder).load(key, self.imgs.cache_rows, self.flat_block_size + 2, compute)
+        else:
+            features = compute(np.arange(len(self.imgs)))
+        self.imgs.features[key] = features
+        return features
+
     def imgs_to_flat_blocks(self, metric: str):
-        img_keys = np.zeros((len(self.imgs), self.block_height, self.block_width, 3), dtype=np.uint8)
-        for i in range(len(self.imgs)):
-            cv2.resize(self.imgs[i], (self.block_width, self.block_height), dst=img_keys[i])
-        img_keys.shape = (-1, self.block_width, 3)
-        img_keys = img_keys * np.float32(1 / 255.0)
-        self.convert_colorspace(img_keys)
-        img_keys.shape = (-1, self.flat_block_size)
+        features = self.block_features()
+        img_keys = features[:-2].T
+        norms = features[-2:]
+        if self.tile_idx is not None:
+            img_keys = img_keys[self.tile_idx]
+            norms = norms[:, self.tile_idx]
         img_keys = cp.asarray(img_keys)
-        self.cdist = CachedCDist(metric, img_keys)
+        self.cdist = CachedCDist(metric, img_keys, cp.asarray(norms))
         self.img_keys = img_keys
         return img_keys
 
@@ -566,8 +1365,8 @@ class MosaicCommon:
         return cp.asarray(dest_img)
 
 
-def calc_salient_col_even(dest_img: np.ndarray, imgs: ImgList, dup=1, colorspace="lab", 
-                          metric="euclidean", lower_thresh=0.5, transparent=False, v=None):
+def calc_salient_col_even(dest_img: np.ndarray, imgs: TileSet, dup=1, colorspace="lab", 
+                          metric="euclidean", lower_thresh=0.5, transparent=False, v=None, renderer=make_collage_helper):
     """
     Compute the optimal assignment between the set of images provided and the set of pixels constitute of salient objects of the
     target image, with the restriction that every image should be used the same amount of times
@@ -580,7 +1379,7 @@ def calc_salient_col_even(dest_img: np.ndarray, imgs: ImgList, dup=1, colorspace
 
     # this is just the initial (minimum) grid size
     total = round(len(imgs) * dup)
-    grid = calc_grid_size(width, height, total, imgs[0].shape)
+    grid = calc_grid_size(width, height, total, imgs.tile_shape)
     if transparent:
         dest_img, orig_thresh_map = thresh_map_transp(dest_img)
         orig_thresh_map = orig_thresh_map.astype(np.float32)
@@ -599,7 +1398,6 @@ def calc_salient_col_even(dest_img: np.ndarray, imgs: ImgList, dup=1, colorspace
         bh_delta = 1
         bw_delta = bh_f / bw_f
     
-    imgs = imgs.copy()
     while True:
         block_width = int(bw_f)
         block_height = int(bh_f)
@@ -617,9 +1415,10 @@ def calc_salient_col_even(dest_img: np.ndarray, imgs: ImgList, dup=1, colorspace
         bh_f -= bh_delta
 
     print(len(ridx), lower_thresh)
-    dup_to_meet_total(imgs, len(ridx))
+    tile_idx = dup_to_meet_total(len(imgs), len(ridx))
 
-    mos = MosaicCommon(imgs, colorspace)
+    mos = MosaicCommon(imgs, colorspace, tile_idx)
+    mos.renderer = renderer
     mos.block_width = block_width
     mos.block_height = block_height
     mos.flat_block_size = block_width * block_height * 3
@@ -639,13 +1438,14 @@ class MosaicFairSalient:
     def __init__(self, *args, **kwargs) -> None:
         self.args = args
         self.kwargs = kwargs
+        self.renderer = make_collage_helper
     
     def process_dest_img(self, dest_img: np.ndarray):
-        return calc_salient_col_even(dest_img, *self.args[1:], **self.kwargs)
+        return calc_salient_col_even(dest_img, *self.args[1:], **self.kwargs, renderer=self.renderer)
 
 
 class MosaicFair(MosaicCommon):
-    def __init__(self, dest_shape: Tuple[int, int, int], imgs: ImgList, dup=1, colorspace="lab", 
+    def __init__(self, dest_shape: Tuple[int, int, int], imgs: TileSet, dup=1, colorspace="lab", 
             metric="euclidean", grid=None) -> None:
         """
         Compute the optimal assignment between the set of images provided and the set of pixels of the target image,
@@ -656,14 +1456,14 @@ class MosaicFair(MosaicCommon):
             dup = np.prod(grid) // len(imgs) + 1
         else:
             # Compute the grid size based on the number images that we have
-            grid = calc_grid_size(dest_shape[1], dest_shape[0], round(len(imgs) * dup), imgs[0].shape)
+            grid = calc_grid_size(dest_shape[1], dest_shape[0], round(len(imgs) * dup), imgs.tile_shape)
         total = np.prod(grid)
-        imgs = dup_to_meet_total(imgs.copy(), total)
+        tile_idx = dup_to_meet_total(len(imgs), total)
         
         if total > 10000:
             print("Warning: this may take longer than 5 minutes to compute")
     
-        super().__init__(imgs, colorspace)
+        super().__init__(imgs, colorspace, tile_idx)
         self.compute_block_size(dest_shape, grid)
         self.imgs_to_flat_blocks(metric)
 
@@ -674,12 +1474,12 @@ class MosaicFair(MosaicCommon):
 
 
 class MosaicUnfair(MosaicCommon):
-    def __init__(self, dest_shape: Tuple[int, int, int], imgs: ImgList, max_width: int, colorspace: str, metric: str, 
+    def __init__(self, dest_shape: Tuple[int, int, int], imgs: TileSet, max_width: int, colorspace: str, metric: str, 
     lower_thresh: float, freq_mul: float, randomize: bool, dither=False, transparent=False) -> None:
         # Because we don't have a fixed total amount of images as we can used a single image
         # for arbitrary amount of times, we need user to specify the maximum width in order to determine the grid size.
         dh, dw, _ = dest_shape
-        th, tw, _ = imgs[0].shape
+        th, tw, _ = imgs.tile_shape
         grid = (max_width, round(dh * (max_width * tw / dw) / th))
         print("Calculated grid size based on the aspect ratio of the image provided:", grid)
         print("Collage size:", (grid[0] * tw, grid[1] * th))
@@ -873,10 +1673,107 @@ class MosaicUnfair(MosaicCommon):
         return self.make_photomosaic(assignment, file=file)
 
 
+def set_encode_options(png_compression=-1, jpeg_quality=95, fast=False, threads=1):
+    """
+    :param png_compression: zlib level of PNG outputs. -1: the default of OpenCV for images encoded in one piece, 
+                            and 1 for images encoded in strips
+    :param jpeg_quality: quality of JPEG outputs
+    :param fast: encode images in strips from a lower size, at PNG level 1 unless png_compression is given
+    :param threads: number of threads encoding the strips of an image in parallel
+    """
+    global PNG_COMPRESSION, JPEG_QUALITY, FAST_ENCODE, ENCODE_THREADS
+    PNG_COMPRESSION = png_compression
+    JPEG_QUALITY = jpeg_quality
+    FAST_ENCODE = fast
+    ENCODE_THREADS = max(1, threads)
+
+
+def png_level(in_strips=True) -> int:
+    if PNG_COMPRESSION >= 0:
+        return PNG_COMPRESSION
+    return 1 if in_strips or FAST_ENCODE else -1
+
+
+STRIP_BYTES = 2**22 # size of the strips an image is encoded in
+STRIP_MIN_PIXELS = 2**23 # images smaller than this are encoded in one piece, or 2**20 with fast encoding
+JPEG_MCU = 16 # the height of the blocks of JPEG images with 4:2:0 chroma subsampling
+
+
+def encode_jpeg_strips(img: np.ndarray, pool: ThreadPool) -> np.ndarray:
+    """
+    Encode a JPEG image in horizontal strips in parallel and stitch them into one baseline JPEG image
+
+    Every strip but the last is a whole number of MCU rows high, and is encoded with a restart marker after every 
+    MCU row, so that no entropy coding state carries over from one MCU row to the next. The scans of the strips are 
+    then joined with restart markers, which are renumbered to continue the sequence of the previous strip, under the 
+    headers of the first strip with the image height patched in. 
+
+    :return: the encoded image, or None if the encoder did not produce a baseline image that can be stitched
+    """
+    h, w = img.shape[:2]
+    params = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY, cv2.IMWRITE_JPEG_RST_INTERVAL, -(-w // JPEG_MCU), 
+              cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420]
+    strip_rows = max(JPEG_MCU, STRIP_BYTES // (w * img.shape[2]) // JPEG_MCU * JPEG_MCU)
+    parts = pool.map(lambda y: cv2.imencode(".jpg", img[y:y + strip_rows], params)[1].ravel(), range(0, h, strip_rows))
+
+    header, scans, num_markers = None, [], 0
+    for part in parts:
+        data = part.tobytes()
+        i, sof, sos_end = 2, -1, -1
+        while i + 4 <= len(data) and data[i] == 0xFF:
+            marker = data[i + 1]
+            length = int.from_bytes(data[i + 2:i + 4], "big")
+            if marker == 0xC0:
+                sof = i
+            elif 0xC1 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                return None # not a baseline image
+            if marker == 0xDA:
+                sos_end = i + 2 + length
+                break
+            i += 2 + length
+        if sof < 0 or sos_end < 0 or data[-2:] != b"\xff\xd9":
+            return None
+        if header is None:
+            header = bytearray(data[:sos_end])
+            header[sof + 5:sof + 7] = h.to_bytes(2, "big")
+        else:
+            scans.append(bytes([0xFF, 0xD0 + num_markers % 8]))
+            num_markers += 1
+        scan = part[sos_end:-2].copy()
+        # 0xFF in the entropy coded data is always followed by 0x00, so FF D0-D7 are the restart markers
+        rst = np.flatnonzero((scan[:-1] == 0xFF) & (scan[1:] >= 0xD0) & (scan[1:] <= 0xD7)) + 1
+        scan[rst] = 0xD0 + (num_markers + np.arange(len(rst))) % 8
+        num_markers += len(rst)
+        scans.append(scan.tobytes())
+    return np.frombuffer(bytes(header) + b"".join(scans) + b"\xff\xd9", dtype=np.uint8)
+
+
 def imwrite(filename: str, img: np.ndarray) -> None:
-    ext = os.path.splitext(filename)[1]
-    result, n = cv2.imencode(ext, img)
-    assert result, "Error saving the collage"
+    """
+    save an image with the options of set_encode_options. Large images are encoded in strips in parallel
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    h, w = img.shape[:2]
+    in_strips = ENCODE_THREADS > 1 and h * w >= (2**20 if FAST_ENCODE else STRIP_MIN_PIXELS)
+    if in_strips and ext == ".png":
+        strip_rows = max(1, STRIP_BYTES // (w * img.shape[2]))
+        code = cv2.COLOR_BGRA2RGBA if img.shape[2] == 4 else cv2.COLOR_BGR2RGB
+        with PNGWriter(filename, w, h, img.shape[2], png_level(), threads=ENCODE_THREADS) as writer:
+            for y in range(0, h, strip_rows):
+                writer.write(cv2.cvtColor(img[y:y + strip_rows], code))
+        return
+    n = None
+    if in_strips and ext in (".jpg", ".jpeg"):
+        with ThreadPool(ENCODE_THREADS) as pool:
+            n = encode_jpeg_strips(strip_alpha(img), pool)
+    if n is None:
+        params = []
+        if ext == ".png" and png_level(False) >= 0:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, png_level(False)]
+        elif ext in (".jpg", ".jpeg"):
+            params = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
+        result, n = cv2.imencode(ext, img, params)
+        assert result, "Error saving the collage"
     n.tofile(filename)
 
 
@@ -896,6 +1793,8 @@ def save_img(img: np.ndarray, path: str, suffix: str, file=None) -> None:
 
 def get_size(img):
     try:
+        if isinstance(img, ArchiveMember):
+            img = io.BytesIO(img.data)
         w, h = imagesize.get(img)
         return int(w), int(h)
     except:
@@ -903,39 +1802,660 @@ def get_size(img):
 
 
 def get_size_slow(filename: str):
-    img = imread(filename)
+    """
+    decode the image to read its size. Files that are not images by their extension or signature are not read
+    """
+    if os.path.splitext(tile_name(filename))[1].lower() in NON_IMAGE_EXTS:
+        return 0, 0
+    img = imread(filename, check_magic=True)
     if img is None:
         return 0, 0
     return img.shape[1::-1]
 
 
-def infer_size(pool: Type[mp.Pool], files: List[str], infer_func: Callable[[str], Tuple[int, int]], i_type: str):
-    sizes = defaultdict(int)
-    for w, h in tqdm(pool.imap_unordered(infer_func, files, chunksize=64), 
-        total=len(files), desc=f"[Inferring size ({i_type})]", ncols=pbar_ncols):
-        if w == 0 or h == 0: # skip zero size images
-            continue
-        sizes[Fraction(w, h)] += 1
-    sizes = [(args[1], args[0].numerator / args[0].denominator) for args in sizes.items()]
+def get_size_any(filename: str):
+    """
+    read the size from the header, and decode the image only if the header cannot be parsed
+    """
+    w, h = get_size(filename)
+    if w <= 0 or h <= 0:
+        return get_size_slow(filename)
+    return w, h
+
+
+def size_stats(sizes: Dict[Fraction, int]) -> List[Tuple[int, float]]:
+    """
+    return (frequency, aspect ratio) pairs sorted by frequency
+    """
+    sizes = [(freq, ratio.numerator / ratio.denominator) for ratio, freq in sizes.items()]
     sizes.sort()
     return sizes
 
 
-def read_images(pic_path: str, img_size: List[int], recursive, pool: mp.Pool, flag="stretch", auto_rotate=0) -> ImgList:
-    assert os.path.isdir(pic_path), "Directory " + pic_path + "is non-existent"
-    files = []
+def add_size(sizes: Dict[Fraction, int], w: int, h: int):
+    if w <= 0 or h <= 0: # skip zero size images. imagesize returns -1 for unknown formats
+        return
+    sizes[Fraction(w, h)] += 1
+
+
+def infer_size(pool: Type[mp.Pool], files: Iterable[str], infer_func: Callable[[str], Tuple[int, int]], i_type: str, sizes=None):
+    sizes = defaultdict(int) if sizes is None else sizes
+    for w, h in tqdm(pool.imap_unordered(infer_func, files, chunksize=64), 
+        total=len(files) if isinstance(files, list) else None, desc=f"[Inferring size ({i_type})]", ncols=pbar_ncols):
+        add_size(sizes, w, h)
+    return size_stats(sizes)
+
+
+SIZE_MIN_SAMPLES = 64
+SIZE_Z_SCORE = 3.0
+
+
+def mode_is_stable(sizes: Dict[Fraction, int]) -> bool:
+    """
+    whether the lead of the most frequent aspect ratio over the second most frequent one is significant
+
+    Conditioned on the sample falling in either of the two ratios, the count of the first one is binomial. 
+    If both were equally frequent, its lead would be within SIZE_Z_SCORE standard deviations (sqrt(c1 + c2)) 
+    with probability > 99.7%
+    """
+    counts = sorted(sizes.values(), reverse=True) + [0, 0]
+    c1, c2 = counts[0], counts[1]
+    return sum(counts) >= SIZE_MIN_SAMPLES and c1 - c2 >= SIZE_Z_SCORE * math.sqrt(c1 + c2)
+
+
+def sample_size(pool: Type[mp.Pool], files: Iterator[str], out: List[str], max_samples: int, batch_size=64):
+    """
+    read the sizes of files until the most frequent aspect ratio is stable or max_samples files have been read
+
+    :param files: the files to sample from. The sampled files are consumed from this iterator and appended to out
+    :return: the sizes in the format of infer_size, and whether the most frequent aspect ratio is stable
+    """
+    sizes = defaultdict(int)
+    if max_samples <= 0:
+        return sizes, False
+    with tqdm(total=max_samples, desc="[Inferring size (sample)]", ncols=pbar_ncols) as pbar:
+        while len(out) < max_samples:
+            batch = list(itertools.islice(files, min(batch_size, max_samples - len(out))))
+            if len(batch) == 0:
+                break
+            out.extend(batch)
+            for w, h in pool.map(get_size_any, batch, chunksize=4):
+                add_size(sizes, w, h)
+            pbar.update(len(batch))
+            if mode_is_stable(sizes):
+                return sizes, True
+    return sizes, False
+
+
+def scan_files(pic_path: str, recursive: bool) -> Iterator[str]:
+    """
+    yield the path of every file in pic_path (and its sub-folders if recursive) as soon as it is found
+    """
+    folders = [pic_path]
+    while folders:
+        sub_folders = []
+        try:
+            with os.scandir(folders.pop()) as it:
+                for entry in it:
+                    # like os.walk, symbolic links to folders are not followed, which could visit a folder many times
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_folders.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path
+        except OSError:
+            continue
+        if recursive:
+            # same order as os.walk: sub-folders are visited in the order they are listed
+            folders.extend(reversed(sub_folders))
+
+
+class ArchiveMember(NamedTuple):
+    """
+    A file in an archive, which is sent to the workers together with its content
+    """
+    name: str # archive path::member path
+    data: bytes
+    stat: Tuple[int, int] # plays the role of (mtime, size) of a file for the tile cache
+
+
+ARCHIVE_BUFSIZE = 2**22
+
+
+def is_archive(path: str) -> bool:
+    return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+def tile_name(f: Union[str, ArchiveMember]) -> str:
+    return f.name if isinstance(f, ArchiveMember) else f
+
+
+def scan_archive(archive: str) -> Iterator[ArchiveMember]:
+    """
+    yield every regular file in a zip or tar archive (which may be compressed) in the order they are stored, 
+    so that the archive is read sequentially in large blocks
+    """
+    if zipfile.is_zipfile(archive):
+        with open(archive, "rb", buffering=ARCHIVE_BUFSIZE) as fp, zipfile.ZipFile(fp) as zf:
+            for info in sorted(zf.infolist(), key=lambda info: info.header_offset):
+                if info.is_dir():
+                    continue
+                # the CRC of the member stands in for the mtime
+                yield ArchiveMember(f"{archive}::{info.filename}", zf.read(info), (info.CRC, info.file_size))
+    else:
+        # stream mode: the members are read in a single pass, so compressed tar files are decompressed only once
+        with tarfile.open(archive, "r|*", bufsize=ARCHIVE_BUFSIZE) as tf:
+            for member in tf:
+                if not member.isfile():
+                    continue
+                data = tf.extractfile(member).read()
+                yield ArchiveMember(f"{archive}::{member.name}", data, (int(member.mtime * 10**9), member.size))
+
+
+def scan_scope(pic_path: str, recursive: bool, archive: bool) -> Callable[[str], bool]:
+    """
+    return whether an absolute path is one that scan_files or scan_archive would find in pic_path if it existed
+    """
+    root = os.path.abspath(pic_path)
+    if archive:
+        return lambda name: name.startswith(root + "::")
+    if recursive:
+        return lambda name: name.startswith(os.path.join(root, "")) and "::" not in name
+    return lambda name: os.path.dirname(name) == root and "::" not in name
+
+
+def collect(files: Iterable[str], out: List[str]) -> Iterator[str]:
+    """
+    pass the files through while appending them to out
+    """
+    for f in files:
+        out.append(f)
+        yield f
+
+
+# approximate size of each shared memory chunk the tiles are decoded into
+CHUNK_BYTES = 2**26
+
+
+class TileStream:
+    """
+    Feeds files to the decode workers as they are found, so that scanning and decoding overlap. 
+
+    Since the number of files is not known in advance, the workers write the tiles into shared memory chunks 
+    that are allocated as more files are found. With a tile cache, files that are cached are not sent to the workers.
+    """
+
+    def __init__(self, files: Iterable[str], img_size: Tuple[int, int], read_img: Callable, auto_rotate: int, cache: TileCache=None, 
+                 shared=True, negative: NegativeCache=None, scope: Callable[[str], bool]=None) -> None:
+        """
+        :param shared: whether the chunks are in shared memory. Set to False if the workers are threads of this process
+        :param negative: the record of files known not to be images, which is only used together with a tile cache
+        :param scope: whether a path is one the scan of files would find, see scan_scope. The cached tiles of the files
+                      in scope that are not found are dropped from the tile cache. By default, every path is in scope
+        """
+        self.files = files
+        self.scope = scope or (lambda name: True)
+        self.negative = negative
+        self.shared = shared
+        self.img_size = img_size
+        self.read_img = read_img
+        self.auto_rotate = auto_rotate
+        self.cache = cache
+        self.tile_shape = (img_size[1], img_size[0], 3)
+        self.chunk_size = max(256, CHUNK_BYTES // int(np.prod(self.tile_shape)))
+        self.chunks = [] # (name, buffer) of each shared memory chunk
+        self.to_read = [] # names of the files sent to the workers. The tile of to_read[k] goes to row k of the chunks
+        self.slot_of = {}
+        self.entries = [] # (name, stat, cache slot) of every file found, if a cache is used
+        self.num_found = 0
+        self.num_cached = 0
+        self.num_skipped = 0 # files that are skipped without being read, by extension or by the negative cache
+        self.num_known_bad = 0 # files skipped by the negative cache
+        self.num_no_signature = 0 # files that were not decoded as they do not start with the signature of an image format
+        self.num_failed = 0 # files that could not be decoded
+        self.failed = set() # names of the files that are not images or failed to decode
+
+    def batches(self, batch_size=32):
+        """
+        group the tasks into batches to reduce IPC overhead
+        """
+        batch = []
+        for task in self.tasks():
+            batch.append(task)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def tasks(self):
+        for f in self.files:
+            self.num_found += 1
+            name = tile_name(f)
+            if os.path.splitext(name)[1].lower() in NON_IMAGE_EXTS:
+                self.num_skipped += 1
+                continue
+            if self.cache is not None:
+                stat = f.stat if isinstance(f, ArchiveMember) else file_stat(f)
+                if self.negative is not None and self.negative.contains(name, stat):
+                    self.num_skipped += 1
+                    self.num_known_bad += 1
+                    continue
+                slot = self.cache.lookup(name, stat)
+                self.entries.append((name, stat, slot))
+                if slot >= 0:
+                    self.num_cached += 1
+                    continue
+
+            k = len(self.to_read)
+            c, row = divmod(k, self.chunk_size)
+            if c == len(self.chunks):
+                shape = (self.chunk_size, *self.tile_shape)
+                self.chunks.append(alloc_shared_tiles(shape) if self.shared else (None, np.empty(shape, dtype=np.uint8)))
+            self.slot_of[name] = k
+            self.to_read.append(name)
+            yield self.read_img, f, self.img_size, self.auto_rotate, self.chunks[c][0], self.chunks[c][1].shape, row
+
+    def tile(self, k: int) -> np.ndarray:
+        c, row = divmod(k, self.chunk_size)
+        return self.chunks[c][1][row]
+
+    def read_local(self, batch: List[Tuple[Callable, str, Tuple[int, int], int, str, Tuple[int, int, int, int], int]]):
+        """
+        Worker function for threads of this process. The tiles are written directly into the chunks
+        """
+        results = []
+        for read_img, img_file, img_size, rot, _, _, _ in batch:
+            name = tile_name(img_file)
+            img = read_img((img_file, img_size, rot))
+            if img is None:
+                results.append((read_failure(img_file), name))
+                continue
+            self.tile(self.slot_of[name])[:] = img
+            results.append((READ_OK, name))
+        return results
+
+    def read(self, pool: mp.Pool) -> TileSet:
+        """
+        decode all files, and return the tiles that were read successfully in the order the files were found
+        """
+        ok = []
+        done = 0
+        results = pool.imap_unordered(read_imgs_shared if self.shared else self.read_local, self.batches())
+        with tqdm(total=0, desc="[Reading files]", unit="file", ncols=pbar_ncols) as pbar:
+            finished = False
+            while not finished:
+                try:
+                    for status, f in results.next(timeout=0.1):
+                        done += 1
+                        if status == READ_OK:
+                            ok.append(self.slot_of[f])
+                            continue
+                        self.failed.add(f)
+                        if status == READ_NO_SIGNATURE:
+                            self.num_no_signature += 1
+                        else:
+                            self.num_failed += 1
+                except mp.TimeoutError:
+                    pass
+                except StopIteration:
+                    finished = True
+                # the total grows while files are being found. Cached and skipped files are done as soon as they are found
+                pbar.total = self.num_found
+                pbar.update(done + self.num_cached + self.num_skipped - pbar.n)
+        ok.sort()
+
+        if self.cache is not None:
+            tiles = self.update_cache(ok)
+        else:
+            tiles = self.gather(ok)
+        self.chunks.clear()
+        return tiles
+
+    def gather(self, ok: List[int]) -> TileSet:
+        if len(ok) == 0:
+            return TileSet(np.empty((0, *self.tile_shape), dtype=np.uint8), [])
+        name, buf = alloc_shared_tiles((len(ok), *self.tile_shape))
+        ok = np.array(ok)
+        k = 0
+        for c, (_, chunk) in enumerate(self.chunks):
+            rows = ok[(ok >= c * self.chunk_size) & (ok < (c + 1) * self.chunk_size)] - c * self.chunk_size
+            buf[k:k + len(rows)] = chunk[rows]
+            k += len(rows)
+        return TileSet(buf, [self.to_read[k] for k in ok], ("shm", name, 0, buf))
+
+    def update_cache(self, ok: List[int]) -> TileSet:
+        ok = set(ok)
+        keep = [(f, stat, slot) for f, stat, slot in self.entries 
+            if stat is not None and (slot >= 0 or self.slot_of[f] in ok)]
+        tiles, slots = self.cache.update(
+            [f for f, _, _ in keep], [stat for _, stat, _ in keep], [slot for _, _, slot in keep], 
+            [self.tile(self.slot_of[f]) for f, _, slot in keep if slot < 0], self.scope)
+        names = [f for f, _, _ in keep]
+        if self.negative is not None:
+            self.negative.update([(f, stat) for f, stat, _ in self.entries if f in self.failed], names)
+        if len(keep) == 0:
+            return TileSet(np.empty((0, *self.tile_shape), dtype=np.uint8), [])
+        if np.all(np.diff(slots) == 1):
+            # the files are stored in the order they were found, which is the case unless files were changed or deleted
+            data = tiles[slots[0]:slots[-1] + 1]
+            result = TileSet(data, names, ("file", self.cache.data_path, tiles.offset, tiles))
+        else:
+            name, buf = alloc_shared_tiles((len(keep), *self.tile_shape))
+            np.take(tiles, slots, axis=0, out=buf)
+            result = TileSet(buf, names, ("shm", name, 0, buf))
+        result.cache_folder = self.cache.folder
+        result.cache_rows = slots
+        return result
+
+
+class TileLoader:
+    """
+    Decodes tiles at full size on demand. 
+    
+    This is used when the tiles were read as small thumbnails that are only used for matching, so that only the tiles 
+    that end up in the output are decoded at full size. Decoded tiles are kept, e.g. for the next frame of a video. 
+    """
+
+    def __init__(self, img_size: Tuple[int, int], read_img: Callable, auto_rotate: int, archive: str=None, 
+                 num_workers: int=None) -> None:
+        """
+        :param archive: the archive the tiles were read from, if any
+        :param num_workers: the number of threads decoding the tiles, by default the number of CPUs
+        """
+        self.img_size = img_size
+        self.tile_shape = (img_size[1], img_size[0], 3)
+        self.read_img = read_img
+        self.auto_rotate = auto_rotate
+        self.archive = archive
+        self.num_workers = num_workers or os.cpu_count()
+        self.loaded = {} # filename -> full size tile
+
+    def _files(self, names: List[str]) -> Iterator[Union[str, ArchiveMember]]:
+        if self.archive is None:
+            yield from names
+            return
+        needed = set(names)
+        for member in scan_archive(self.archive):
+            if member.name in needed:
+                yield member
+                needed.remove(member.name)
+                if not needed:
+                    return
+
+    def load(self, thumbs: TileSet, assignment: np.ndarray, file=None) -> Tuple[TileSet, np.ndarray]:
+        """
+        :param thumbs: the thumbnails
+        :param assignment: indices into thumbs, with -1 for transparent tiles
+        :return: the full size tiles of the thumbnails used in the assignment, and the assignment that indexes into them
+        """
+        valid = assignment >= 0
+        used, inverse = np.unique(assignment[valid], return_inverse=True)
+        names = thumbs.names[used]
+        missing = [name for name in names if name not in self.loaded]
+        if len(missing) > 0:
+            print(f"Decoding {len(missing)} tiles at full size...", file=file)
+            # decoding releases the GIL, so threads are enough
+            files = list(self._files(missing))
+            with ThreadPool(self.num_workers) as pool:
+                imgs = pool.imap(self.read_img, [(f, self.img_size, self.auto_rotate) for f in files], chunksize=4)
+                for f, img in zip(files, tqdm(imgs, desc="[Decoding tiles]", total=len(files), ncols=pbar_ncols, file=file)):
+                    self.loaded[tile_name(f)] = img
+            num_unreadable = sum(self.loaded.get(name) is None for name in missing)
+            if num_unreadable > 0:
+                print(f"Warning: {num_unreadable} tiles could not be read at full size", file=file)
+        
+        data = np.empty((len(used), *self.tile_shape), dtype=np.uint8)
+        for k, (i, name) in enumerate(zip(used, names)):
+            img = self.loaded.get(name)
+            if img is None:
+                # the file has changed or disappeared since the thumbnail was read
+                img = cv2.resize(thumbs.data[i], self.img_size, interpolation=cv2.INTER_CUBIC)
+            data[k] = img
+        new_assignment = np.full_like(assignment, -1)
+        new_assignment[valid] = inverse
+        return TileSet(data, names), new_assignment
+
+
+def dhash_tiles(imgs: TileSet, chunk_size=4096) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the 64-bit difference hash of each tile: the signs of the horizontal gradients of the tile 
+    shrunk to 9x8 grayscale pixels. The hash ignores color, so the average color of each tile is returned as well
+
+    :return: the hashes as uint64 of shape (N,), and the average BGR colors of shape (N, 3)
+    """
+    n, h, w, _ = imgs.shape
+    hashes = np.empty(n, dtype=np.uint64)
+    colors = np.empty((n, 3), dtype=np.float32)
+    weights = 1 << np.arange(63, -1, -1, dtype=np.uint64)
+    for start in range(0, n, chunk_size):
+        chunk = imgs.data[start:start + chunk_size]
+        k = len(chunk)
+        gray = cv2.cvtColor(chunk.reshape(-1, w, 3), cv2.COLOR_BGR2GRAY).reshape(k, h, w)
+        # place the tiles side by side. With area interpolation, each output pixel only covers pixels of one tile
+        # as the tile boundaries line up with the output pixel boundaries
+        small = cv2.resize(gray.transpose(1, 0, 2).reshape(h, k * w), (9 * k, 8), interpolation=cv2.INTER_AREA)
+        small = small.reshape(8, k, 9).transpose(1, 0, 2).astype(np.int16)
+        bits = (small[:, :, 1:] > small[:, :, :-1]).reshape(k, 64)
+        hashes[start:start + k] = bits @ weights
+        colors[start:start + k] = chunk.reshape(k, -1, 3).mean(axis=1)
+    return hashes, colors
+
+
+def popcount64(x: np.ndarray) -> np.ndarray:
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+DEDUP_COLOR_THRESH = 12 # maximum difference in any channel of the average colors of two duplicate tiles
+
+
+# the offsets from a cell of average colors to half of its 26 neighbors, so that each pair of neighbors is visited once
+_NEIGHBOR_CELLS = [d for d in itertools.product((-1, 0, 1), repeat=3) if d > (0, 0, 0)]
+
+
+def group_hashes(hashes: np.ndarray, thresh: int, colors: np.ndarray=None, chunk_size=2**22, max_bucket=1024) -> np.ndarray:
+    """
+    Group hashes that are within the given Hamming distance of each other, transitively.
+
+    Equal hashes (and colors) are collapsed first, so that exact duplicates cost nothing. The bits that differ between 
+    the hashes are then split into thresh + 1 bands. Two hashes that differ in at most thresh bits must agree on at least 
+    one band, so only distinct hashes that share a band are compared. A large bucket of hashes sharing a band is split 
+    again the same way by the bits that differ within it. A bucket that is still large, e.g. flat tiles that have the 
+    same hash but different colors, is split into cells of side DEDUP_COLOR_THRESH by the colors, and only the hashes 
+    in the same or neighboring cells are compared. The groups are the connected components of the close pairs.
+
+    :param colors: if given, the average colors of the tiles, which must also be within DEDUP_COLOR_THRESH
+    :param chunk_size: maximum number of pairs compared at once
+    :param max_bucket: buckets up to this size are compared pair by pair without being split further
+
+    :return: the group of each hash, given as the smallest index in the group
+    """
+    if colors is None:
+        keys = hashes
+    else:
+        keys = np.empty(len(hashes), dtype=[("hash", np.uint64), ("color", colors.dtype, 3)])
+        keys["hash"] = hashes
+        keys["color"] = colors
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    # number the distinct keys in the order they first appear, so that the smallest number in a group is its first tile
+    order = np.argsort(first)
+    first = first[order]
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    inverse = rank[inverse]
+    uniq = hashes[first]
+    uniq_colors = None if colors is None else colors[first]
+
+    # each distinct key points to a smaller one in its group, or to itself if it is the smallest found so far
+    labels = np.arange(len(uniq))
+
+    def roots(x: np.ndarray) -> np.ndarray:
+        r = labels[x]
+        while True:
+            parent = labels[r]
+            if np.array_equal(parent, r):
+                break
+            r = parent
+        labels[x] = r
+        return r
+
+    def union(i: np.ndarray, j: np.ndarray):
+        # link the roots of the pairs to the smaller root until every pair has the same root
+        while len(i) > 0:
+            ri, rj = roots(i), roots(j)
+            differ = ri != rj
+            if not differ.any():
+                break
+            i, j, ri, rj = i[differ], j[differ], ri[differ], rj[differ]
+            np.minimum.at(labels, ri, rj)
+            np.minimum.at(labels, rj, ri)
+
+    def link(a: np.ndarray, b: np.ndarray=None):
+        """
+        join the groups of the close pairs between a and b, or within a if b is not given
+        """
+        m = len(a) if b is None else len(b)
+        step = max(1, chunk_size // max(1, m))
+        # compare a few rows of a at a time against b, or against the rest of a after them
+        for r in range(0, len(a) - (b is None), step):
+            rows, others = a[r:r + step], (a[r + 1:] if b is None else b)
+            close = popcount64(uniq[rows][:, None] ^ uniq[others][None, :]) <= thresh
+            if uniq_colors is not None:
+                for ch in range(3):
+                    close &= np.abs(uniq_colors[rows, ch, None] - uniq_colors[others, ch]) <= DEDUP_COLOR_THRESH
+            i, j = np.nonzero(np.triu(close) if b is None else close)
+            union(rows[i], others[j])
+
+    def link_cells(bucket: np.ndarray, close_hashes: bool):
+        """
+        join the groups of the close pairs in the bucket, comparing only the colors in the same or neighboring cells
+
+        :param close_hashes: whether all hashes in the bucket are known to be within thresh bits of each other
+        """
+        cells = (uniq_colors[bucket] // DEDUP_COLOR_THRESH).astype(np.int64)
+        # the coordinates start from 1, so that the neighbors of every cell have a valid key
+        cells -= cells.min(axis=0) - 1
+        size = int(cells.max()) + 2
+        keys = (cells[:, 0] * size + cells[:, 1]) * size + cells[:, 2]
+        order = np.argsort(keys, kind="stable")
+        members, keys = bucket[order], keys[order]
+        cell_keys, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+        # the pairs of cells to compare, as indices into cell_keys
+        pairs_a, pairs_b = [], []
+        if close_hashes:
+            # the colors in a cell are within DEDUP_COLOR_THRESH of each other, so all of them are close
+            same = keys[:-1] == keys[1:]
+            union(members[:-1][same], members[1:][same])
+        else:
+            pairs_a.append(np.arange(len(cell_keys)))
+            pairs_b.append(np.arange(len(cell_keys)))
+        for dx, dy, dz in _NEIGHBOR_CELLS:
+            target = cell_keys + (dx * size + dy) * size + dz
+            pos = np.minimum(np.searchsorted(cell_keys, target), len(cell_keys) - 1)
+            found = cell_keys[pos] == target
+            pairs_a.append(np.flatnonzero(found))
+            pairs_b.append(pos[found])
+        a, b = np.concatenate(pairs_a), np.concatenate(pairs_b)
+        num_pairs = counts[a] * counts[b]
+        # the pairs of members of the pairs of cells are compared chunk_size at a time
+        chunk_of = (np.cumsum(num_pairs) - 1) // chunk_size
+        for sel in np.split(np.arange(len(a)), np.flatnonzero(np.diff(chunk_of)) + 1):
+            rep = np.repeat(sel, num_pairs[sel])
+            local = np.arange(len(rep)) - np.repeat(np.cumsum(num_pairs[sel]) - num_pairs[sel], num_pairs[sel])
+            ia, ib = np.divmod(local, counts[b[rep]])
+            # each pair within a cell is compared once
+            keep = (a[rep] != b[rep]) | (ia < ib)
+            i, j = members[starts[a[rep]] + ia][keep], members[starts[b[rep]] + ib][keep]
+            close = popcount64(uniq[i] ^ uniq[j]) <= thresh
+            for ch in range(3):
+                close &= np.abs(uniq_colors[i, ch] - uniq_colors[j, ch]) <= DEDUP_COLOR_THRESH
+            union(i[close], j[close])
+
+    def compare(bucket: np.ndarray, depth: int):
+        """
+        :param depth: the number of times the bucket has been split by bands
+        """
+        # the bits that differ within the bucket. Only they can tell hashes apart
+        h = uniq[bucket]
+        differ = np.bitwise_or.reduce(h) & ~np.bitwise_and.reduce(h)
+        bits = np.flatnonzero((differ >> np.arange(64, dtype=np.uint64)) & np.uint64(1))
+        if len(bits) <= thresh:
+            # every pair of hashes is close
+            if uniq_colors is not None:
+                link_cells(bucket, True)
+            else:
+                union(bucket[:-1], bucket[1:])
+        elif len(bucket) <= max_bucket:
+            link(bucket)
+        elif depth < 2:
+            for band_bits in np.array_split(bits, thresh + 1):
+                band = h & np.bitwise_or.reduce(np.uint64(1) << band_bits.astype(np.uint64))
+                members = np.argsort(band, kind="stable")
+                starts = np.flatnonzero(np.diff(band[members])) + 1
+                for sub in np.split(bucket[members], starts):
+                    if len(sub) > 1:
+                        compare(sub, depth + 1)
+        elif uniq_colors is not None:
+            link_cells(bucket, False)
+        else:
+            link(bucket)
+
+    if len(uniq) > 1:
+        compare(np.arange(len(uniq)), 0)
+    labels = roots(np.arange(len(uniq)))
+    return first[labels[inverse]]
+
+
+def dedup_tiles(imgs: TileSet, thresh: int) -> TileSet:
+    """
+    Remove near-duplicate tiles, keeping the first tile of each group of tiles whose 
+    perceptual hashes are within the given Hamming distance
+    """
+    assert 0 <= thresh < 64, "The dedup threshold must be between 0 and 63"
+    print("Removing duplicate tiles...")
+    hashes, colors = dhash_tiles(imgs)
+    groups = group_hashes(hashes, thresh, colors)
+    keep = np.flatnonzero(groups == np.arange(len(imgs)))
+    print(f"Removed {len(imgs) - len(keep)} near-duplicate tiles. {len(keep)} tiles remaining.")
+    if len(keep) == len(imgs):
+        return imgs
+    return imgs.take(keep)
+
+
+def read_images(pic_path: str, img_size: List[int], recursive, pool: mp.Pool, flag="stretch", auto_rotate=0, cache_dir="", 
+                size_sample=1000, match_width=0, num_workers: int=None) -> TileSet:
+    """
+    :param pool: the worker processes, or a ThreadPool to decode the tiles with threads of this process
+    :param match_width: if positive and smaller than the tile width, the tiles are read at this width. 
+                        Tiles are then decoded at full size only when they are rendered
+    :param num_workers: the number of threads decoding the tiles at full size, by default the number of CPUs
+    """
+    archive = is_archive(pic_path)
+    assert archive or os.path.isdir(pic_path), "Directory " + pic_path + "is non-existent"
     print("Scanning files...")
-    for root, _, file_list in os.walk(pic_path):
-        for f in file_list:
-            files.append(os.path.join(root, f))
-        if not recursive:
-            break
+    files = scan_archive(pic_path) if archive else scan_files(pic_path, recursive)
 
     if len(img_size) == 1:
-        sizes = infer_size(pool, files, get_size, "fast")
-        if len(sizes) == 0:
-            print("Warning: unable to infer image size through metadata. Will try reading the entire image (slow!)")
-            sizes = infer_size(pool, files, get_size_slow, "slow")
+        # the sizes are read while scanning. The files read are kept to decode them afterwards
+        found = []
+        sizes, stable = sample_size(pool, files, found, size_sample)
+        if stable:
+            sizes = size_stats(sizes)
+            files = itertools.chain(found, files)
+        else:
+            if size_sample > 0 and len(found) == size_sample:
+                print("The most frequent aspect ratio is ambiguous in the sampled files. Scanning all files...")
+            # the sampled files are already counted. The members of an archive are not kept in memory, 
+            # so the archive is read again afterwards
+            sizes = infer_size(pool, files if archive else collect(files, found), get_size, "fast", sizes)
+            files = scan_archive(pic_path) if archive else found
+            if len(sizes) == 0:
+                print("Warning: unable to infer image size through metadata. Will try reading the entire image (slow!)")
+                sizes = infer_size(pool, files, get_size_slow, "slow")
+                files = scan_archive(pic_path) if archive else found
             assert len(sizes) > 0, "Fail to infer size. All of your images are in an unsupported format!"
 
         # print("Aspect ratio (width / height, sorted by frequency) statistics:")
@@ -954,36 +2474,218 @@ def read_images(pic_path: str, img_size: List[int], recursive, pool: mp.Pool, fl
         read_img = read_img_center
     if flag == "fit":
         read_img = read_img_fit
-    result = [
-        r for r in tqdm(
-            pool.imap_unordered(
-                read_img, 
-                zip(files, itertools.repeat(img_size, len(files)), itertools.repeat(auto_rotate, len(files))), 
-            chunksize=32), 
-            total=len(files), desc="[Reading files]", unit="file", ncols=pbar_ncols) 
-                if r is not None
-    ]
-    print(f"Read {len(result)} images. {len(files) - len(result)} files cannot be decoded as images.")
+    loader = None
+    if 0 < match_width < img_size[0]:
+        loader = TileLoader(img_size, read_img, auto_rotate, pic_path if archive else None, num_workers)
+        img_size = (match_width, max(1, round(match_width * img_size[1] / img_size[0])))
+        print("Reading tiles at size", img_size, "for matching")
+
+    cache = TileCache(cache_dir, img_size, flag, auto_rotate) if cache_dir else None
+    negative = NegativeCache(cache_dir) if cache_dir else None
+    stream = TileStream(files, img_size, read_img, auto_rotate, cache, not isinstance(pool, ThreadPool), negative, 
+                        scan_scope(pic_path, recursive, archive))
+    result = stream.read(pool)
+    result.loader = loader
+    if cache is not None:
+        print(f"{stream.num_cached} tiles were loaded from the cache. {len(stream.to_read)} files were read.")
+    num_skipped = stream.num_skipped + stream.num_no_signature
+    if num_skipped > 0:
+        print(f"{num_skipped} files were skipped as they are not images: {stream.num_skipped - stream.num_known_bad} by "
+              f"extension, {stream.num_no_signature} by signature, {stream.num_known_bad} as recorded in the cache.")
+    print(f"Read {len(result)} images. {stream.num_failed} files cannot be decoded as images.")
     return result
 
 
-def imread(filename: str, flag=cv2.IMREAD_COLOR) -> np.ndarray:
+READ_OK = 0
+READ_FAILED = 1 # the file looks like an image but could not be decoded
+READ_NO_SIGNATURE = 2 # the file does not start with the signature of an image format, so it was not decoded
+
+
+def read_failure(img_file: Union[str, "ArchiveMember"]) -> int:
     """
-    like cv2.imread, but can read images whose path contain unicode characters
+    tell whether a file that read_img could not read is not an image or failed to decode. Only called on failures
     """
     try:
-        f = np.fromfile(filename, np.uint8)
-        if not f.size:
+        if isinstance(img_file, ArchiveMember):
+            head = img_file.data[:16]
+        else:
+            with open(img_file, "rb") as fp:
+                head = fp.read(16)
+    except OSError:
+        return READ_FAILED
+    return READ_FAILED if has_image_magic(head) else READ_NO_SIGNATURE
+
+# shared memory blocks that this worker process has attached to, by name
+_attached_tiles = {}
+
+
+def _release_shm(shm: shared_memory.SharedMemory):
+    shm.close()
+    shm.unlink()
+
+
+def alloc_shared_tiles(shape: Tuple[int, int, int, int]) -> Tuple[str, np.ndarray]:
+    """
+    Allocate a (N, h, w, 3) uint8 tile buffer in shared memory, which pool workers can attach to by its name.
+    The block is unlinked once the returned array and all views of it are garbage-collected
+
+    :return: [name of the shared memory block, the tile buffer]
+    """
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+    buf = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    # views of buf keep buf alive, so this runs only when no tile refers to the block anymore
+    weakref.finalize(buf, _release_shm, shm)
+    return shm.name, buf
+
+
+_private_tracker = {} # pid -> whether the resource tracker of the process was started by the process itself
+
+
+def _attach_shm(name: str) -> shared_memory.SharedMemory:
+    if sys.version_info >= (3, 13):
+        # the block is owned by the process that allocated it, so it is not registered with the resource tracker
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Python 3.8 to 3.12 have no track argument, and the resource tracker is worked around through its private state: 
+    # attaching registers the block with the resource tracker of this process. If this process has no tracker yet 
+    # (e.g. a pool worker forked before the block was allocated), a private one is started, which would unlink the block
+    # when this process exits. The block is owned by the process that allocated it, so it is unregistered from a private tracker.
+    # A tracker shared with the owner just ignores the duplicate registration
+    private_tracker = _private_tracker.setdefault(os.getpid(), resource_tracker._resource_tracker._fd is None)
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name == "posix" and private_tracker:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def open_shared_tiles(name: str) -> np.ndarray:
+    """
+    Map a whole shared memory block allocated by alloc_shared_tiles as a flat uint8 array. 
+    The block is closed (but not unlinked) once the array and all views of it are garbage-collected
+    """
+    shm = _attach_shm(name)
+    buf = np.ndarray(shm.size, dtype=np.uint8, buffer=shm.buf)
+    weakref.finalize(buf, shm.close)
+    return buf
+
+
+def attach_shared_tiles(name: str, shape: Tuple[int, int, int, int]) -> np.ndarray:
+    """
+    Attach to a tile buffer allocated by alloc_shared_tiles in the parent process
+    """
+    if name not in _attached_tiles:
+        # only the most recent block is needed. Blocks from previous calls to read_images are detached
+        for shm in _attached_tiles.values():
+            shm.close()
+        _attached_tiles.clear()
+        _attached_tiles[name] = _attach_shm(name)
+    return np.ndarray(shape, dtype=np.uint8, buffer=_attached_tiles[name].buf)
+
+
+def read_img_shared(args: Tuple[Callable, str, Tuple[int, int], int, str, Tuple[int, int, int, int], int]):
+    """
+    Worker function that reads a tile with read_img and writes it into row `slot` of a shared tile buffer
+    """
+    read_img, img_file, img_size, rot, buf_name, buf_shape, slot = args
+    img = read_img((img_file, img_size, rot))
+    if img is None:
+        return read_failure(img_file), tile_name(img_file)
+    attach_shared_tiles(buf_name, buf_shape)[slot] = img
+    return READ_OK, tile_name(img_file)
+
+
+def read_imgs_shared(batch: List[Tuple[Callable, str, Tuple[int, int], int, str, Tuple[int, int, int, int], int]]):
+    return [read_img_shared(args) for args in batch]
+
+
+# extensions of files that are commonly found next to images, but are never images themselves
+NON_IMAGE_EXTS = {
+    ".xmp", ".json", ".xml", ".txt", ".ini", ".db", ".aae", ".thm", ".pdf", ".zip", # sidecar and metadata files
+    ".mp4", ".mov", ".avi", ".mkv", ".m4v", ".3gp", ".mts", ".wmv", ".webm", ".mp3", ".wav", ".m4a", # videos and audio
+    ".cr2", ".cr3", ".nef", ".arw", ".orf", ".rw2", ".raf", ".raw", ".srw", ".pef", ".dng", # camera RAW files
+}
+
+
+def has_image_magic(head: bytes) -> bool:
+    """
+    whether the first bytes of a file match the signature of a format that cv2.imdecode supports
+    """
+    if head.startswith((b"\xff\xd8\xff", b"\x89PNG", b"BM", b"II*\x00", b"MM\x00*", b"GIF8", b"\xff\x4f\xff\x51", 
+                        b"\x00\x00\x00\x0cjP  ", b"\x59\xa6\x6a\x95", b"\x76\x2f\x31\x01", b"#?RADIANCE", b"#?RGBE", b"PF", b"Pf")):
+        return True
+    if len(head) >= 2 and head[0:1] == b"P" and head[1:2] in b"1234567": # PBM, PGM, PPM and PAM
+        return True
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    return head[4:8] == b"ftyp" and head[8:12] in (b"avif", b"avis")
+
+
+def read_bytes(filename: Union[str, "ArchiveMember"], check_magic=False) -> np.ndarray:
+    """
+    read the whole file. If check_magic, return None without reading the rest if the file does not start 
+    with the signature of an image format
+    """
+    if isinstance(filename, ArchiveMember):
+        if check_magic and not has_image_magic(filename.data[:16]):
+            return None
+        return np.frombuffer(filename.data, np.uint8)
+    if not check_magic:
+        return np.fromfile(filename, np.uint8)
+    with open(filename, "rb") as fp:
+        if not has_image_magic(fp.read(16)):
+            return None
+        fp.seek(0)
+        return np.fromfile(fp, np.uint8)
+
+
+def imread(filename: Union[str, "ArchiveMember"], flag=cv2.IMREAD_COLOR, check_magic=False) -> np.ndarray:
+    """
+    like cv2.imread, but can read images whose path contain unicode characters, and members of an archive
+
+    :param check_magic: do not read files that do not start with the signature of an image format
+    """
+    try:
+        f = read_bytes(filename, check_magic)
+        if f is None or not f.size:
             return None
         return cv2.imdecode(f, flag)
     except:
         return None
 
 
+# flags to decode JPEG files at 1/8, 1/4 and 1/2 of their resolution
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+# the SOF marker carrying the size of a JPEG file is usually within the first few KB, after the EXIF data
+JPEG_HEADER_BYTES = 2**18
+
+
+def imread_tile(filename: Union[str, "ArchiveMember"], img_size: Tuple[int, int]) -> np.ndarray:
+    """
+    like imread, but a JPEG file that is much larger than the tile is decoded at a reduced resolution (1/2, 1/4 or 1/8),
+    so that the decoded image is just above the tile size. Other files are decoded at full resolution. 
+    """
+    try:
+        f = read_bytes(filename, check_magic=True)
+        if f is None or f.size < 2:
+            return None
+        if f[0] == 0xFF and f[1] == 0xD8:
+            w, h = imagesize.get(io.BytesIO(f[:JPEG_HEADER_BYTES].tobytes()))
+            # the reduced image must cover the tile in either orientation, as it might be rotated or cropped later
+            scale = min(w, h) // max(img_size)
+            for factor, flag in REDUCED_FLAGS:
+                if scale >= factor:
+                    img = cv2.imdecode(f, flag)
+                    if img is not None:
+                        return img
+                    break
+        return cv2.imdecode(f, cv2.IMREAD_COLOR)
+    except:
+        return None
+
+
 def read_img_center(args: Tuple[str, Tuple[int, int], int]):
     # crop the largest square from the center of a non-square image
     img_file, img_size, rot = args
-    img = imread(img_file)
+    img = imread_tile(img_file, img_size)
     if img is None:
         return None
     
@@ -1013,7 +2715,7 @@ def read_img_center(args: Tuple[str, Tuple[int, int], int]):
 
 def read_img_other(args: Tuple[str, Tuple[int, int], int]):
     img_file, img_size, rot = args
-    img = imread(img_file)
+    img = imread_tile(img_file, img_size)
     if img is None:
         return img
     
@@ -1060,7 +2762,7 @@ def resizeAndPad(img, size, padColor=1.0):
 
 def read_img_fit(args: Tuple[str, Tuple[int, int], int]):
     img_file, img_size, rot = args
-    img = imread(img_file)
+    img = imread_tile(img_file, img_size)
     if img is None:
         return img
     
@@ -1098,9 +2800,9 @@ def unfair_exp(dest_img: np.ndarray, args, imgs):
     all_freqs[1:] = np.logspace(-2, 2, 5)
 
     pbar = tqdm(desc="[Experimenting]", total=len(all_freqs) + len(all_colorspaces) + 1, unit="exps")
-    mos_bgr = MosaicUnfair(dest_img.shape, imgs, args.max_width, "bgr", args.metric, None, None, 1.0, not args.deterministic)
+    mos_bgr = MosaicUnfair(dest_img.shape, imgs, args.max_width, "bgr", args.metric, None, 1.0, not args.deterministic)
     mos_fair = MosaicFair(dest_img.shape, imgs, colorspace="bgr", grid=mos_bgr.grid)
-    change_cp = _HelperChangeColorspace(dest_img, dest_img.shape, imgs, args.max_width, None, args.metric, None, None, 1.0, not args.deterministic)
+    change_cp = _HelperChangeColorspace(dest_img, dest_img.shape, imgs, args.max_width, None, args.metric, None, 1.0, not args.deterministic)
     change_freq = _HelperChangeFreq(dest_img, mos_bgr)
 
     with mp.Pool(4) as pool:
@@ -1131,14 +2833,63 @@ def unfair_exp(dest_img: np.ndarray, args, imgs):
 
 def sort_exp(pool, args, imgs):
     n = len(PARAMS.sort.choices)
-    for sort_method, (grid, sorted_imgs) in zip(
+    for sort_method, (grid, order) in zip(
         PARAMS.sort.choices, pool.starmap(sort_collage, 
             zip(itertools.repeat(imgs, n), 
             itertools.repeat(args.ratio, n), 
             PARAMS.sort.choices, 
-            itertools.repeat(args.rev_sort, n))
+            itertools.repeat(args.rev_sort, n),
+            itertools.repeat(args.layout, n))
         )):
-        save_img(make_collage(grid, sorted_imgs, args.rev_row)[0], args.out, sort_method)
+        save_img(make_collage(grid, imgs, args.rev_row and args.layout == "rows", order)[0], args.out, sort_method)
+
+
+class LazyPool:
+    """
+    A process pool that is only started when it is first used, so that runs whose stages do not need worker processes
+    (e.g. reading the tiles with --io_backend thread) do not pay for starting them. It can be used in place of mp.Pool
+    """
+
+    def __init__(self, processes: int) -> None:
+        self.processes = processes
+        self.pool = None
+
+    def __getattr__(self, name: str):
+        if self.pool is None:
+            self.pool = mp.Pool(self.processes)
+        return getattr(self.pool, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.pool is not None:
+            self.pool.terminate()
+
+
+def io_benchmark(args):
+    """
+    time reading the tiles with each io backend, including starting the workers. The tile cache is not used
+    """
+    timings = {}
+    num_workers = max(1, args.num_process)
+    # each backend is run twice and the best time is taken, so that both read from a warm file system cache
+    for backend in ["process", "thread"] * 2:
+        with open(os.devnull, "w") as null:
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = null
+            try:
+                start = time.perf_counter()
+                with (mp.Pool if backend == "process" else ThreadPool)(num_workers) as p:
+                    imgs = read_images(args.path, args.size, args.recursive, p, args.resize_opt, args.auto_rotate, "", args.size_sample)
+                elapsed = time.perf_counter() - start
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+        timings[backend] = min(timings.get(backend, math.inf), elapsed)
+    print(f"Read {len(imgs)} images with {num_workers} workers")
+    for backend, elapsed in timings.items():
+        print(f"{backend:>8}: {elapsed:.2f}s")
+    print("Fastest io_backend:", min(timings, key=timings.get))
 
 
 def frame_generator(ret, frame, dest_video, skip_frame):
@@ -1150,20 +2901,53 @@ def frame_generator(ret, frame, dest_video, skip_frame):
         i += 1
 
 
-BlendFunc = Callable[[np.ndarray, np.ndarray, int], np.ndarray]
+def output_renderer(args, dest_img: np.ndarray=None, blend_func: BlendFunc=None, alpha=1.0):
+    """
+    return the renderer for the output options. Renderers that write the output while it is rendered return no image, 
+    and make_collage_helper returns the image, which is not blended yet
+    """
+    if os.path.splitext(args.out)[1].lower() == DZIWriter.ext:
+        renderer = DZIWriter(args.out, dest_img, blend_func, alpha, fmt=args.dzi_format)
+    elif args.stream:
+        renderer = CollageStreamer(args.out, dest_img, blend_func, alpha)
+    else:
+        renderer = make_collage_helper
+    if args.manifest_out:
+        renderer = ManifestRecorder(args.manifest_out, renderer, args.resize_opt, args.auto_rotate)
+    return renderer
+
+
+def render_from_manifest(args):
+    """
+    the --render_from entry point
+    """
+    dest_img = imread(args.dest_img, cv2.IMREAD_UNCHANGED) if len(args.dest_img) > 0 else None
+    blend_func = alpha_blend if args.blending == "alpha" else brightness_blend
+    renderer = output_renderer(args, dest_img, blend_func, 1.0 - args.blending_level)
+    collage, tile_info = render_manifest(args.render_from, args.size or (), renderer, num_workers=max(1, args.num_process))
+    if collage is not None:
+        if dest_img is not None:
+            collage = blend_func(collage, dest_img, 1.0 - args.blending_level, inplace=True)
+        save_img(collage, args.out, "")
+    if args.tile_info_out:
+        with open(args.tile_info_out, "w", encoding="utf-8") as f:
+            f.write(tile_info)
 
 
 def process_frame(frame: np.ndarray, mos: MosaicUnfair, blend_func: BlendFunc, blending_level: float, file=None):
     collage = mos.process_dest_img(frame, file=file)[0]
     if blending_level > 0.0:
-        collage = blend_func(collage, frame, 1.0 - blending_level)
+        collage = blend_func(collage, frame, 1.0 - blending_level, inplace=True)
     return collage
 
 
-def frame_process(mos: MosaicUnfair, blend_func: BlendFunc, blending_level: float, path: str, in_q: mp.Queue, out_q: mp.Queue):
+def frame_process(mos: MosaicUnfair, blend_func: BlendFunc, blending_level: float, path: str, in_q: mp.Queue, out_q: mp.Queue, 
+                  encode_options: Tuple[int, int, bool]=(-1, 95, False)):
     """
     Worker function that receives a frame from in_q, compute photomosaic and put it in out_q
     """
+    # the frames are already encoded in parallel by the workers
+    set_encode_options(*encode_options, threads=1)
     with open(os.devnull, "w") as null:
         while True:
             i, frame = in_q.get()
@@ -1227,23 +3011,50 @@ def main(args):
         if len(folder) > 0:
             assert os.path.isdir(folder), "The output path {} does not exist!".format(folder)
         ext = os.path.splitext(file_name)[-1].lower()
-        assert ext == ".jpg" or ext == ".png" or ext == ".jpeg", "The file extension must be .jpg, .jpeg or .png"
+        assert ext in (".jpg", ".png", ".jpeg", ".dzi"), "The file extension must be .jpg, .jpeg, .png or .dzi"
+        assert not (ext == ".dzi" and args.video), "Deep Zoom output is not supported for videos"
+        assert not args.stream or ext == ".png", "The output must be a .png file with --stream"
+    assert not (args.manifest_out and args.video), "--manifest_out is not supported for videos"
+    assert not (args.stream and args.video), "--stream is not supported for videos"
     if args.quiet:
         sys.stdout = open(os.devnull, "w")
+    set_encode_options(args.png_compression, args.jpeg_quality, args.fast_encode, num_process)
     
     dup = check_dup_valid(args.dup)
     if len(args.dest_img) > 0:
         assert os.path.isfile(args.dest_img), f"Non existent destination image {args.dest_img}" # early check
+
+    if len(args.render_from) > 0:
+        assert not args.video, "--render_from is not supported for videos"
+        render_from_manifest(args)
+        return
+    if args.size is None:
+        args.size = [50]
     
-    with mp.Pool(max(1, num_process)) as pool:
-        imgs = read_images(args.path, args.size, args.recursive, pool, args.resize_opt, args.auto_rotate)
+    if args.io_benchmark:
+        io_benchmark(args)
+        return
+
+    with LazyPool(max(1, num_process)) as pool:
+        if args.io_backend == "thread":
+            with ThreadPool(num_process) as thread_pool:
+                imgs = read_images(args.path, args.size, args.recursive, thread_pool, args.resize_opt, args.auto_rotate, 
+                                   args.cache_dir, args.size_sample, args.match_width, num_process)
+        else:
+            imgs = read_images(args.path, args.size, args.recursive, pool, args.resize_opt, args.auto_rotate, args.cache_dir, 
+                               args.size_sample, args.match_width, num_process)
+        if args.dedup:
+            imgs = dedup_tiles(imgs, args.dedup_thresh)
         
         if len(args.dest_img) == 0: # sort mode
             if args.exp:
                 sort_exp(pool, args, imgs)
             else:
-                collage, tile_info = make_collage(*sort_collage(imgs, args.ratio, args.sort, args.rev_sort), args.rev_row)
-                save_img(collage, args.out, "")
+                grid, order = sort_collage(imgs, args.ratio, args.sort, args.rev_sort, args.layout, pool)
+                collage, tile_info = make_collage(grid, imgs, args.rev_row and args.layout == "rows", order, 
+                                                  output_renderer(args))
+                if collage is not None:
+                    save_img(collage, args.out, "")
                 if args.tile_info_out:
                     with open(args.tile_info_out, "w", encoding="utf-8") as f:
                         f.write(tile_info)
@@ -1297,7 +3108,7 @@ def main(args):
         blend_func = brightness_blend
 
     if args.video:
-        th, tw, _ = mos.imgs[0].shape
+        th, tw, _ = mos.imgs.tile_shape
         res = (tw * mos.grid[0], th * mos.grid[1])
         print("Photomosaic video resolution:", res)
         frames_gen = frame_generator(ret, frame, dest_video, args.skip_frame)
@@ -1311,7 +3122,8 @@ def main(args):
             out_q = mp.Queue()
             processes = []
             for i in range(num_process):
-                p = mp.Process(target=frame_process, args=(mos, blend_func, args.blending_level, args.out, in_q, out_q)) 
+                p = mp.Process(target=frame_process, args=(mos, blend_func, args.blending_level, args.out, in_q, out_q, 
+                                                           (args.png_compression, args.jpeg_quality, args.fast_encode)))
                 p.start()
                 processes.append(p)
 
@@ -1334,15 +3146,15 @@ def main(args):
         
         frames_gen.close()
     else:
+        mos.renderer = output_renderer(args, dest_img, blend_func, 1.0 - args.blending_level)
         collage, tile_info = mos.process_dest_img(dest_img)
-        collage = blend_func(collage, dest_img, 1.0 - args.blending_level)
-        save_img(collage, args.out, "")
+        if collage is not None:
+            collage = blend_func(collage, dest_img, 1.0 - args.blending_level, inplace=True)
+            save_img(collage, args.out, "")
         if args.tile_info_out:
             with open(args.tile_info_out, "w", encoding="utf-8") as f:
                 f.write(tile_info)
 
-    pool.close()
-
 if __name__ == "__main__":
     mp.freeze_support()
     parser = argparse.ArgumentParser(
@@ -2,13 +2,20 @@ import os
 import io
 import sys
 import time
+import zlib
 import queue
+import struct
 import ctypes
 import platform
 import tempfile
 import threading
 from tkinter import Text, END
+from collections import deque
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from typing import Tuple
 
 from tqdm import tqdm
 
@@ -147,3 +154,130 @@ class SafeText(Text):
             self.see("end-1c")
         self.update_idletasks()
         self.after(50, self.update_me)
+
+
+def adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+    """
+    the Adler-32 checksum of the concatenation of two byte strings, given their checksums and the length of the second
+    (zlib's adler32_combine, which Python does not expose)
+    """
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % base
+    sum1 = (sum1 + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + base - rem) % base
+    return (sum2 << 16) | sum1
+
+
+class PNGWriter:
+    """
+    Write a PNG image a few rows at a time, so that the whole image never needs to be held in memory
+
+    Each row is filtered with the Sub filter and compressed, and the compressed data is written out as IDAT chunks 
+    as soon as it is produced. With one thread, all rows are compressed by a single zlib stream. With more threads, 
+    each call to write is compressed as an independent raw deflate stream ending with a sync flush in a thread pool, 
+    and the streams are concatenated into one zlib stream whose checksum is combined from those of the parts.
+    """
+
+    def __init__(self, filename: str, width: int, height: int, channels=4, level=6, strategy=zlib.Z_DEFAULT_STRATEGY, 
+                 threads=1):
+        """
+        :param channels: 3 for RGB or 4 for RGBA
+        :param level: zlib compression level
+        :param strategy: zlib compression strategy, e.g. zlib.Z_RLE for speed
+        :param threads: number of threads compressing in parallel
+        """
+        assert channels in (3, 4), "Only RGB and RGBA images are supported"
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.level = level
+        self.strategy = strategy
+        self.rows_written = 0
+        self.executor = None
+        if threads > 1:
+            self.executor = ThreadPoolExecutor(threads)
+            self.pending = deque()
+            self.max_pending = 2 * threads
+            self.adler = zlib.adler32(b"")
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 8, strategy)
+        self.f = open(filename, "wb")
+        self.f.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per channel, color type 2 (RGB) or 6 (RGBA), no interlacing
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2 if channels == 3 else 6, 0, 0, 0))
+
+    def _chunk(self, tag: bytes, data: bytes):
+        self.f.write(struct.pack(">I", len(data)))
+        self.f.write(tag)
+        self.f.write(data)
+        self.f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(tag))))
+
+    def write(self, rows: np.ndarray):
+        """
+        :param rows: the next rows of the image in RGB(A) order, of shape (n, width, channels)
+        """
+        assert rows.shape[1:] == (self.width, self.channels) and rows.dtype == np.uint8
+        assert self.rows_written + len(rows) <= self.height, "Too many rows"
+        rows = rows.reshape(len(rows), -1)
+        filtered = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1 # Sub: each byte minus the byte of the same channel in the previous pixel
+        filtered[:, 1:self.channels + 1] = rows[:, :self.channels]
+        np.subtract(rows[:, self.channels:], rows[:, :-self.channels], out=filtered[:, self.channels + 1:])
+        if self.executor is None:
+            data = self.compressor.compress(filtered.data)
+            if data:
+                self._chunk(b"IDAT", data)
+        else:
+            if self.rows_written == 0:
+                self._chunk(b"IDAT", b"\x78\x01") # zlib header: deflate with a 32K window
+            self.pending.append(self.executor.submit(self._compress_part, filtered))
+            while len(self.pending) > self.max_pending:
+                self._write_part()
+        self.rows_written += len(rows)
+
+    def _compress_part(self, filtered: np.ndarray) -> Tuple[bytes, int, int]:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, 8, self.strategy)
+        data = compressor.compress(filtered.data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data, zlib.adler32(filtered.data), filtered.nbytes
+
+    def _write_part(self):
+        data, adler, length = self.pending.popleft().result()
+        self.adler = adler32_combine(self.adler, adler, length)
+        self._chunk(b"IDAT", data)
+
+    def close(self):
+        if self.f.closed:
+            return
+        try:
+            assert self.rows_written == self.height, f"Expected {self.height} rows but {self.rows_written} were written"
+            if self.executor is None:
+                self._chunk(b"IDAT", self.compressor.flush())
+            else:
+                while self.pending:
+                    self._write_part()
+                # an empty final block ends the deflate stream, followed by the checksum
+                end = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+                self._chunk(b"IDAT", end + struct.pack(">I", self.adler))
+            self._chunk(b"IEND", b"")
+        finally:
+            self.f.close()
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+            return
+        # the image is incomplete, so the partial file is removed instead of being finalized
+        self.f.close()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        try:
+            os.remove(self.f.name)
+        except OSError:
+            pass
@@ -0,0 +1,350 @@
+import os
+import glob
+import json
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+FileStat = Tuple[int, int] # (mtime in ns, size in bytes)
+CACHE_VERSION = 2
+
+
+def file_stat(filename: str) -> Optional[FileStat]:
+    try:
+        st = os.stat(filename)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+class TileCache:
+    """
+    A persistent store of resized tiles that is updated in place
+
+    All tiles read with the same tile size, resize option and auto rotation setting are kept in one raw uint8 file 
+    (tiles.bin) holding an array of shape (capacity, h, w, 3). index.json records the absolute path, mtime, size and row 
+    of every cached file, so that a file is only decoded again when it is new or has changed since it was cached. 
+    
+    When files are deleted or changed, their rows become free and are reused by new tiles, and new tiles that do not fit 
+    are appended. Only the new tiles are written, so the cost of an update scales with the number of changed files. 
+    The file is compacted once more than half of its rows are free.
+
+    The block features of the tiles are kept next to them by FeatureCache, one row per tile row. The feature rows of
+    the rows that receive new tiles are invalidated, and the feature rows are moved along with the tiles on compaction.
+    """
+
+    def __init__(self, cache_dir: str, img_size: Tuple[int, int], flag: str, auto_rotate: int) -> None:
+        self.params = {"size": list(img_size), "resize_opt": flag, "auto_rotate": auto_rotate}
+        self.tile_shape = (img_size[1], img_size[0], 3)
+        self.folder = os.path.join(cache_dir, f"{img_size[0]}x{img_size[1]}-{flag}-rot{auto_rotate}")
+        self.index_path = os.path.join(self.folder, "index.json")
+        self.data_path = os.path.join(self.folder, "tiles.bin")
+        self.tiles = None
+        self.capacity = 0
+        self.entries = {}
+        os.makedirs(self.folder, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("version") != CACHE_VERSION or index.get("params") != self.params:
+                return
+            capacity = index["capacity"]
+            if os.path.getsize(self.data_path) < capacity * int(np.prod(self.tile_shape)):
+                return
+            entries = {name: (slot, mtime, size) for name, mtime, size, slot in index["files"]}
+        except (OSError, ValueError, KeyError):
+            return
+        self.capacity = capacity
+        self.entries = entries
+        self.tiles = self._map("r")
+
+    def _map(self, mode: str) -> np.ndarray:
+        if self.capacity == 0:
+            return np.empty((0, *self.tile_shape), dtype=np.uint8)
+        return np.memmap(self.data_path, dtype=np.uint8, mode=mode, shape=(self.capacity, *self.tile_shape))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, filename: str, stat: Optional[FileStat]) -> int:
+        """
+        return the row of the cached tile for this file, or -1 if the file is not cached or has changed
+        """
+        if stat is None:
+            return -1
+        entry = self.entries.get(os.path.abspath(filename))
+        if entry is None or (entry[1], entry[2]) != stat:
+            return -1
+        return entry[0]
+
+    def update(self, filenames: List[str], stats: List[FileStat], slots: List[int], new_tiles: List[np.ndarray], 
+               in_scope: Callable[[str], bool]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Update the cache with the files of a scan. Cached files that are not given are kept, since the cache may hold 
+        the tiles of other folders and archives, unless the scan would have found them or they no longer exist
+
+        :param filenames: the files the cache should hold
+        :param stats: the (mtime, size) of each file
+        :param slots: for each file, the row of its tile in the current cache, or -1 if it is a newly decoded tile
+        :param new_tiles: the newly decoded tiles, in the order they appear in filenames
+        :param in_scope: whether an absolute path is one the scan would have found if it still existed
+        :return: the memory-mapped tiles of the cache, and the row of each of the given files in it
+        """
+        names = [os.path.abspath(f) for f in filenames]
+        stats = list(stats)
+        slots = list(slots)
+        num_given = len(names)
+        given = set(names)
+        for name, (slot, mtime, size) in self.entries.items():
+            # an archive member exists as long as its archive does
+            if name not in given and not in_scope(name) and os.path.exists(name.split("::")[0]):
+                names.append(name)
+                stats.append((mtime, size))
+                slots.append(slot)
+        slots = np.array(slots, dtype=np.int64)
+        new = np.flatnonzero(slots < 0)
+        assert len(new) == len(new_tiles)
+        if len(new) == 0 and len(names) == len(self.entries):
+            return self.tiles, slots[:num_given]
+
+        features = FeatureCache(self.folder)
+        if len(names) == 0:
+            self.capacity = 0
+            slots = np.empty(0, dtype=np.int64)
+            open(self.data_path, "wb").close()
+            features.clear()
+        elif 2 * len(names) < self.capacity:
+            self._compact(slots, new_tiles)
+            features.compact(slots)
+            slots = np.arange(len(names))
+        else:
+            free = np.setdiff1d(np.arange(self.capacity), slots[slots >= 0])
+            num_appended = max(0, len(new) - len(free))
+            slots[new] = np.concatenate([free[:len(new)], np.arange(self.capacity, self.capacity + num_appended)])
+            # release the read-only mapping before writing to the file
+            self.tiles = None
+            with open(self.data_path, "ab") as f:
+                f.truncate((self.capacity + num_appended) * int(np.prod(self.tile_shape)))
+            self.capacity += num_appended
+            out = self._map("r+")
+            for slot, tile in zip(slots[new], new_tiles):
+                out[slot] = tile
+            out.flush()
+            del out
+            features.invalidate(slots[new])
+
+        index = {"version": CACHE_VERSION, "params": self.params, "capacity": self.capacity, 
+                 "files": [[n, *st, int(slot)] for n, st, slot in zip(names, stats, slots)]}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+        self._load()
+        return self.tiles, slots[:num_given]
+
+    def _compact(self, slots: np.ndarray, new_tiles: List[np.ndarray]):
+        """
+        rewrite the tiles in the order of the files
+        """
+        tmp_path = self.data_path + ".tmp"
+        out = np.memmap(tmp_path, dtype=np.uint8, mode="w+", shape=(len(slots), *self.tile_shape))
+        new_tiles = iter(new_tiles)
+        for i, slot in enumerate(slots):
+            out[i] = self.tiles[slot] if slot >= 0 else next(new_tiles)
+        out.flush()
+        del out
+        # release the old mapping before replacing the file underneath it
+        self.tiles = None
+        os.replace(tmp_path, self.data_path)
+        self.capacity = len(slots)
+
+
+class NegativeCache:
+    """
+    A persistent record of the files that cannot be decoded as images
+
+    The record is kept in bad_files.json in the cache directory and shared by all tile sizes and resize options, since
+    whether a file can be decoded does not depend on them. A file is skipped without being read until its mtime or size changes.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.path = os.path.join(cache_dir, "bad_files.json")
+        self.entries = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("version") == CACHE_VERSION:
+                self.entries = {name: (mtime, size) for name, mtime, size in index["files"]}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def contains(self, filename: str, stat: Optional[FileStat]) -> bool:
+        return stat is not None and self.entries.get(os.path.abspath(filename)) == tuple(stat)
+
+    def update(self, failed: List[Tuple[str, FileStat]], decoded: List[str]) -> None:
+        """
+        :param failed: (filename, stat) of the files that failed to decode in this run
+        :param decoded: the files that were decoded in this run, which are removed from the record
+        """
+        changed = False
+        for name, stat in failed:
+            name = os.path.abspath(name)
+            if stat is not None and self.entries.get(name) != tuple(stat):
+                self.entries[name] = tuple(stat)
+                changed = True
+        for name in decoded:
+            changed |= self.entries.pop(os.path.abspath(name), None) is not None
+        if not changed:
+            return
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "files": [[n, *s] for n, s in self.entries.items()]}, f)
+        os.replace(tmp_path, self.path)
+
+
+class FeatureCache:
+    """
+    A persistent store of the block features and sort keys of the tiles of a TileCache, kept in the folder of the TileCache
+
+    The features of each block size and colorspace, and the keys of each sort method, are kept in a .npy file 
+    (features-{key}.bin) holding an array 
+    of shape (length, capacity), column i holding the features of the tile in row i of tiles.bin. This is the layout 
+    the features are used in, so that the features of the tiles of a scan, which usually occupy consecutive rows, are 
+    returned as a read-only memory-mapped view without being copied. A flag file (features-{key}.valid) records which 
+    rows hold the features of the current tile in the row, so that only the features of new tiles are computed. 
+    Worker processes that load the same features map the same file, so they share the features through the page cache.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.folder, f"features-{key}")
+        return base + ".bin", base + ".valid"
+
+    def _keys(self) -> List[str]:
+        return [os.path.basename(p)[len("features-"):-len(".valid")] 
+                for p in glob.glob(os.path.join(glob.escape(self.folder), "features-*.valid"))]
+
+    @staticmethod
+    def _open(data_path: str, length: int=None, dtype=None) -> Optional[np.ndarray]:
+        """
+        map the features read-only, or return None if there is no valid file (of this length and dtype)
+        """
+        try:
+            data = np.load(data_path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        if data.ndim != 2 or (length is not None and data.shape[0] != length) or (dtype is not None and data.dtype != dtype):
+            return None
+        return data
+
+    def load(self, key: str, rows: np.ndarray, length: int, compute: Callable[[np.ndarray], np.ndarray], 
+             dtype=np.float32) -> np.ndarray:
+        """
+        :param rows: the rows of the tiles in the TileCache
+        :param length: the number of features of a tile
+        :param compute: computes the features of the tiles at the given indices into rows, as an array of shape (length, k)
+        :return: the features of the tiles, of shape (length, len(rows)). This is a read-only view of the file 
+                 if the rows are consecutive, and a copy otherwise
+        """
+        data_path, valid_path = self._paths(key)
+        capacity = int(rows.max()) + 1 if len(rows) > 0 else 0
+        data = self._open(data_path, length, dtype)
+        if data is None and os.path.exists(valid_path):
+            # the flags are meaningless without the features they refer to
+            os.remove(valid_path)
+        # extend the flag file if the tile cache has grown. The new rows are not valid
+        with open(valid_path, "ab") as f:
+            if f.tell() < capacity:
+                f.truncate(capacity)
+        if capacity == 0:
+            return np.empty((length, 0), dtype=dtype)
+
+        old_capacity = 0 if data is None else data.shape[1]
+        if old_capacity < capacity:
+            # a column cannot be appended in place, so the file is rewritten. It grows by half at least, 
+            # so that the cost of rewriting it is amortized over the new tiles
+            tmp_path = data_path + ".tmp"
+            grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, 
+                                              shape=(length, max(capacity, old_capacity * 3 // 2)))
+            if data is not None:
+                grown[:, :old_capacity] = data
+            grown.flush()
+            # release the mappings before replacing the file
+            del grown, data
+            os.replace(tmp_path, data_path)
+
+        valid = np.fromfile(valid_path, dtype=np.uint8, count=capacity)
+        missing = np.flatnonzero(valid[rows] == 0)
+        if len(missing) > 0:
+            out = np.load(data_path, mmap_mode="r+")
+            out[:, rows[missing]] = compute(missing)
+            out.flush()
+            del out
+            # the flags are written after the features, so that an interrupted run never leaves stale rows valid
+            flags = np.memmap(valid_path, dtype=np.uint8, mode="r+")
+            flags[rows[missing]] = 1
+            flags.flush()
+            del flags
+        data = self._open(data_path, length, dtype)
+        if rows[-1] - rows[0] + 1 == len(rows) and np.all(np.diff(rows) == 1):
+            return data[:, rows[0]:rows[-1] + 1]
+        return data[:, rows]
+
+    def invalidate(self, rows: np.ndarray) -> None:
+        """
+        mark the features of rows that received new tiles as stale
+        """
+        if len(rows) == 0:
+            return
+        for key in self._keys():
+            _, valid_path = self._paths(key)
+            valid = np.memmap(valid_path, dtype=np.uint8, mode="r+")
+            rows_in_file = rows[rows < len(valid)]
+            valid[rows_in_file] = 0
+            valid.flush()
+            del valid
+
+    def compact(self, slots: np.ndarray, chunk_size=64) -> None:
+        """
+        move the features along with the tiles when the TileCache is compacted: row i of the new files is row slots[i] 
+        of the old ones, or not valid if slots[i] < 0
+
+        :param chunk_size: the number of features moved at a time, which bounds the memory used
+        """
+        for key in self._keys():
+            data_path, valid_path = self._paths(key)
+            data = self._open(data_path)
+            if data is None:
+                os.remove(valid_path)
+                continue
+            valid = np.fromfile(valid_path, dtype=np.uint8)
+            kept = (slots >= 0) & (slots < min(len(valid), data.shape[1]))
+            new_valid = np.zeros(len(slots), dtype=np.uint8)
+            new_valid[kept] = valid[slots[kept]]
+            new_data = np.lib.format.open_memmap(data_path + ".tmp", mode="w+", dtype=data.dtype, 
+                                                 shape=(data.shape[0], len(slots)))
+            for i in range(0, data.shape[0], chunk_size):
+                new_data[i:i + chunk_size, kept] = data[i:i + chunk_size, slots[kept]]
+            new_data.flush()
+            del new_data, data
+            os.replace(data_path + ".tmp", data_path)
+            new_valid.tofile(valid_path + ".tmp")
+            os.replace(valid_path + ".tmp", valid_path)
+
+    def clear(self) -> None:
+        for key in self._keys():
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass